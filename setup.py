@@ -35,6 +35,7 @@ setup(
                       'natsort==5.4.1', 'beautifulsoup4==4.6.3',
                       'polyglot==16.7.4', 'pyicu==2.3.1',
                       'pycld2==0.31', 'morfessor==2.0.4', 'tqdm==4.35.0'],
+    extras_require={'zstd': ['zstandard>=0.15'], 'numpy': ['numpy']},
     dependency_links=[
         'https://github.com/akb89/wikiextractor/tarball/master#egg=wikiextractor-3.0.4'],
     classifiers=['Development Status :: 5 - Production/Stable',
@@ -1,4 +1,5 @@
 """To export for toolkit use."""
-from .main import tokenize
+from .main import tokenize, tokenize_batch
+from .utils.tokenids import TokenIdCorpus
 
-__all__ = ('tokenize')
+__all__ = ('tokenize', 'tokenize_batch', 'TokenIdCorpus')
@@ -0,0 +1,14 @@
+"""Docstring.
+
+Details
+"""
+
+__all__ = ('DownloadError')
+
+
+class DownloadError(Exception):
+    """A specific exception for failed or corrupted downloads."""
+
+    def __init__(self, message):  # pylint:disable=W0235
+        """Init function."""
+        super().__init__(message)
@@ -6,23 +6,37 @@ This is the entry point of the application.
 import os
 import argparse
 import multiprocessing
-import urllib.request
 import functools
+import math
 import shutil
-import re
-import bz2
+import itertools
+import collections
 import logging
 import logging.config
-import pycld2
 
 from tqdm import tqdm
-from polyglot.text import Text
-from bs4 import BeautifulSoup
 
 import wikiextractor
 
+from witokit.exceptions.parameter import InvalidParameterError
+from witokit.utils.tokenizers import tokenize, tokenize_batch
+
+import witokit.utils.batch as bautils
+import witokit.utils.bench as bmutils
+import witokit.utils.compression as zutils
 import witokit.utils.config as cutils
+import witokit.utils.dedup as ddutils
+import witokit.utils.constants as const
+import witokit.utils.downloads as dutils
+import witokit.utils.dumps as dmutils
 import witokit.utils.files as futils
+import witokit.utils.manifest as mutils
+import witokit.utils.metrics as mtutils
+import witokit.utils.sampling as sautils
+import witokit.utils.scheduler as scutils
+import witokit.utils.streams as sutils
+import witokit.utils.tokenids as tiutils
+import witokit.utils.tokenizers as tokutils
 import witokit.utils.urls as uutils
 
 logging.config.dictConfig(
@@ -31,203 +45,629 @@ logging.config.dictConfig(
 
 logger = logging.getLogger(__name__)
 
-__all__ = ('tokenize')
-
-
-def _download_href(output_dirpath, wiki_dump_url, href):
-    url = uutils.get_wiki_arxiv_url(wiki_dump_url, href)
-    logger.debug('Downloading {}'.format(url))
-    output_filepath = futils.get_download_output_filepath(output_dirpath,
-                                                          href)
-    try:
-        urllib.request.urlretrieve(url, output_filepath)
-    except urllib.error.HTTPError as error:
-        logger.error('Could not download archive from {}'.format(url))
-        raise error
-
-
-def _parallel_download(wiki_arxiv_hrefs, wiki_dump_url, num_threads,
-                       output_dirpath):
-    with multiprocessing.Pool(num_threads) as pool:
-        _download_href_to_output_dir = functools.partial(_download_href,
-                                                         output_dirpath,
-                                                         wiki_dump_url)
-        for _ in tqdm(pool.imap_unordered(_download_href_to_output_dir,
-                                          wiki_arxiv_hrefs),
-                      total=len(wiki_arxiv_hrefs)):
-            continue
-
-
-def _collect_wiki_arxiv_hrefs(wiki_dump_url, lang, date):
-    wiki_arxiv_hrefs = []
-    try:
-        logger.info('Collecting arxiv from {}'.format(wiki_dump_url))
-        response = urllib.request.urlopen(wiki_dump_url)
-        html_doc = response.read()
-        soup = BeautifulSoup(html_doc, 'html.parser')
-        for link in soup.find_all('a'):
-            pattern = uutils.get_wikipedia_multi_pattern(lang, date)
-            href = link.get('href')
-            if re.match(pattern, href):
-                wiki_arxiv_hrefs.append(href)
-        if not wiki_arxiv_hrefs:
-            logger.info('No multi arxivs found. Trying for single arxiv')
-            # If wikipedia arxiv is too small, check for single arxiv
-            for link in soup.find_all('a'):
-                pattern = uutils.get_wikipedia_single_pattern(lang, date)
-                href = link.get('href')
-                if re.match(pattern, href):
-                    wiki_arxiv_hrefs.append(href)
-        if not wiki_arxiv_hrefs:
-            logger.warning('No wikipedia arxiv found')
-    except urllib.error.HTTPError as error:
-        logger.error('HTTPError using lang = \'{}\' and date = \'{}\'. '
-                     'Could not retrieve any Wikipedia data at URL = {}'
-                     .format(lang, date, wiki_dump_url))
-        raise error
-    return wiki_arxiv_hrefs
+# Number of articles of a stdin stream tokenized per worker task
+ARTICLES_PER_BATCH = 100
+
+__all__ = ('tokenize', 'tokenize_batch')
+
+
+def _batch(args):
+    bautils.batch(args, _preprocess)
+
+
+def _bench(args):
+    bmutils.bench(args, _process)
+
+
+def _parallel_download(downloads, max_connections, max_retries):
+    with tqdm(unit='B', unit_scale=True, unit_divisor=1024) as progress, \
+            dutils.DownloadEngine(max_connections, max_retries,
+                                  progress=progress.update) as engine:
+        for output_filepath in engine.download_all(downloads):
+            logger.debug('Downloaded {}'.format(output_filepath))
+    mtutils.increment('downloaded_files', engine.files_downloaded)
+    mtutils.increment('downloaded_bytes', engine.bytes_downloaded)
+    logger.info('Downloaded {} archives ({:.1f} MB) at {:.2f} MB/s'
+                .format(engine.files_downloaded,
+                        engine.bytes_downloaded / 1e6,
+                        engine.throughput / 1e6))
 
 
 def _download(args):
-    wiki_dump_url = uutils.get_wikipedia_dump_url(args.lang, args.date)
+    wiki_dump_url = uutils.get_wikipedia_dump_url(args.lang, args.date,
+                                                  args.mirror)
     logger.info('Downloading Wikipedia .bz2 archives from {}'
                 .format(wiki_dump_url))
-    wiki_arxiv_hrefs = _collect_wiki_arxiv_hrefs(wiki_dump_url, args.lang,
-                                                 args.date)
-    _parallel_download(wiki_arxiv_hrefs, wiki_dump_url, args.num_threads,
-                       args.output_dirpath)
-
-
-def _decompress_arxiv(arxiv):
-    inc_decompressor = bz2.BZ2Decompressor()
-    logger.debug('Extracting archive {}'.format(arxiv))
-    output_arxiv_filepath = arxiv.rsplit('.bz2')[0]
-    with open(arxiv, 'rb') as arxiv_byte_stream:
-        with open(output_arxiv_filepath, 'wb') as out_stream:
-            for data in iter(lambda: arxiv_byte_stream.read(100 * 1024), b''):
-                out_stream.write(inc_decompressor.decompress(data))
+    dump_files = dmutils.get_dump_files(wiki_dump_url, args.lang, args.date,
+                                        args.multistream, args.cache_dirpath)
+    dmutils.log_download_plan(dump_files, wiki_dump_url)
+    max_connections = args.max_connections
+    if args.num_threads:
+        logger.warning('--num-threads is deprecated for download. '
+                       'Use --max-connections instead')
+        max_connections = args.num_threads
+    _parallel_download(dmutils.get_downloads(dump_files, wiki_dump_url,
+                                             args.output_dirpath),
+                       max_connections, args.max_retries)
+
+
+def _get_arxiv_chunks(bz2_arxivs, num_threads, incremental=False):
+    """Return the list of ArxivChunks to be processed by num_threads workers.
+
+    Archives larger than the maximum task size are split, when they are
+    multistream, into chunks of at most that size. In incremental runs,
+    the maximum task size is MAX_CHUNK_SIZE, so that archives are split
+    the same way whatever the other archives and num_threads.
+    """
+    arxiv_sizes = [os.path.getsize(arxiv) for arxiv in bz2_arxivs]
+    if incremental:
+        max_task_size = scutils.MAX_CHUNK_SIZE
+    else:
+        max_task_size = scutils.get_max_task_size(sum(arxiv_sizes),
+                                                  num_threads)
+    return [chunk for arxiv, arxiv_size in zip(bz2_arxivs, arxiv_sizes)
+            for chunk in sutils.split_arxiv(
+                arxiv, math.ceil(arxiv_size / max_task_size)
+                if max_task_size else 1)]
+
+
+def _schedule(tasks, num_threads, key=scutils.get_task_size):
+    """Return tasks sorted largest first, logging the expected makespan."""
+    tasks = scutils.schedule(tasks, key)
+    task_sizes = [key(task) for task in tasks]
+    makespan = scutils.get_makespan(task_sizes, num_threads)
+    ideal_makespan = sum(task_sizes) / num_threads
+    logger.info('Scheduled {} tasks on {} workers: expected makespan of '
+                '{:.1f} MB for an ideal makespan of {:.1f} MB ({:.0%} '
+                'efficiency)'.format(len(tasks), num_threads, makespan / 1e6,
+                                     ideal_makespan / 1e6,
+                                     ideal_makespan / makespan
+                                     if makespan else 1))
+    return tasks
+
+
+def _decompress_arxiv(chunk, num_threads=1):
+    logger.debug('Extracting archive {}'.format(chunk.arxiv))
+    output_arxiv_filepath = sutils.get_xml_filepath(chunk)
+    with open(output_arxiv_filepath, 'wb') as out_stream, \
+            mtutils.timer('decompress'):
+        for data in sutils.iter_decompressed(chunk.arxiv, chunk.start,
+                                             chunk.end, chunk.header_end,
+                                             num_threads, chunk.offsets):
+            out_stream.write(data)
+    return chunk
+
+
+def _get_input_filepaths(input_sources):
+    """Return the archive or XML filepaths of input_sources."""
+    return {input_source.arxiv
+            if isinstance(input_source, sutils.ArxivChunk) else input_source
+            for input_source in input_sources}
+
+
+def _remove_stale_outputs(manifest_filepath, entries, output_filepaths,
+                          input_filepaths):
+    """Remove outputs previously generated from input_filepaths.
+
+    Outputs not in output_filepaths, e.g. chunks of an archive which is now
+    split differently or shards of a run with more shards, are deleted
+    along with their manifest entries.
+    """
+    output_filepaths = {os.path.abspath(filepath)
+                        for filepath in output_filepaths}
+    input_filepaths = {os.path.abspath(filepath)
+                       for filepath in input_filepaths}
+    stale_filepaths = [
+        output_filepath for output_filepath, entry in entries.items()
+        if output_filepath not in output_filepaths
+        and any(fingerprint['path'] in input_filepaths
+                for fingerprint in entry['inputs'])]
+    for output_filepath in stale_filepaths:
+        logger.debug('Removing stale output {}'.format(output_filepath))
+        if os.path.exists(output_filepath):
+            os.remove(output_filepath)
+        del entries[output_filepath]
+    if stale_filepaths:
+        mutils.save(manifest_filepath, entries)
 
 
 def _extract(args):
     logger.info('Extracting .bz2 files from {}'.format(args.bz2_input_dirpath))
+    if args.decompress_threads < 1:
+        raise InvalidParameterError('--decompress-threads should be >= 1')
+    # Each worker of the pool decompresses its archives with
+    # decompress_threads threads, within a budget of num_threads threads
+    num_workers = max(1, args.num_threads // args.decompress_threads)
     bz2_arxivs = futils.get_bz2_arxivs(args.bz2_input_dirpath)
-    total_arxivs = len(bz2_arxivs)
-    with multiprocessing.Pool(args.num_threads) as pool:
-        for _ in tqdm(pool.imap_unordered(_decompress_arxiv, bz2_arxivs),
-                      total=total_arxivs):
-            continue
-
-
-def _preprocess(output_txt_filepath, lowercase, input_xml_filepath):
-    """Extract content of wikipedia XML file.
+    arxiv_chunks = _get_arxiv_chunks(bz2_arxivs, num_workers,
+                                     incremental=True)
+    manifest_filepath = futils.get_manifest_filepath(args.bz2_input_dirpath)
+    entries = mutils.load(manifest_filepath)
+    _remove_stale_outputs(manifest_filepath, entries,
+                          [sutils.get_xml_filepath(chunk)
+                           for chunk in arxiv_chunks], bz2_arxivs)
+    todo_chunks = _schedule(
+        [chunk for chunk in arxiv_chunks if not mutils.is_up_to_date(
+            entries, sutils.get_xml_filepath(chunk), [chunk], {}, args.hash)],
+        num_workers)
+    if len(todo_chunks) < len(arxiv_chunks):
+        logger.info('Skipping {} archives already extracted'
+                    .format(len(arxiv_chunks) - len(todo_chunks)))
+    with multiprocessing.Pool(num_workers,
+                              initializer=mtutils.init_worker,
+                              initargs=(args.profile, 'extract')) as pool:
+        decompress_arxiv = functools.partial(
+            mtutils.run_task, functools.partial(
+                _decompress_arxiv, num_threads=args.decompress_threads))
+        for chunk in tqdm(mtutils.collect(pool.imap_unordered(
+                decompress_arxiv, todo_chunks)), total=len(todo_chunks)):
+            mutils.add_entry(entries, sutils.get_xml_filepath(chunk),
+                             [chunk], {}, args.hash)
+            mutils.save(manifest_filepath, entries)
+
+
+def _tokenize_source(input_source, lowercase, lang, tokenizer,
+                     output_stream):
+    """Tokenize the content of input_source to output_stream.
 
     Extract content of json.text as given by wikiextractor and tokenize
-    content with polyglot. Output one-sentence-per-line, lowercase, tokenized
-    text.
+    content with the tokenizer backend (polyglot by default). Output
+    one-sentence-per-line, lowercase, tokenized text, skipping empty lines.
+    input_source is either an XML filepath or an ArxivChunk of a .bz2
+    archive, which is then decompressed on the fly and streamed to
+    wikiextractor. If lang is None, it is inferred from the archive
+    filename, or else detected for each article.
     """
+    input_xml_filepath = sutils.get_xml_filepath(input_source)
     logger.debug('Processing content of wikipedia file {}'
                  .format(input_xml_filepath))
-    output_filepath = futils.get_output_filepath(input_xml_filepath,
-                                                 output_txt_filepath)
-    with open(output_filepath, 'w', encoding='utf-8') as output_stream:
+    if not lang:
+        lang = futils.get_wiki_lang(input_xml_filepath)
+    tokenize_sentences = tokutils.get_sentence_tokenizer(tokenizer, lang)
+    with sutils.xml_source(input_source) as xml_filepath:
+        # Time spent in wikiextractor includes waiting for decompression
+        raw_texts = (json_object['text'] for json_object in mtutils.timed(
+            'wikiextractor', wikiextractor.extract(xml_filepath)))
+        for raw_text in raw_texts:
+            # Sentences are written one by one as soon as they are tokenized
+            # so that the output of an article is never held in memory
+            num_sentences = 0
+            num_tokens = 0
+            for sentence in mtutils.timed('tokenize', tokutils.iter_sentences(
+                    tokenize_sentences, raw_text, lowercase)):
+                num_sentences += 1
+                num_tokens += sentence.count(' ') + 1
+                try:
+                    with mtutils.timer('write'):
+                        output_stream.write(sentence)
+                        output_stream.write('\n')
+                except UnicodeEncodeError as err:
+                    logger.error('UnicodeEncodeError processing '
+                                 'json_object[\'text\'] with {}: {}'
+                                 .format(tokenizer, str(err)))
+            mtutils.increment('articles_extracted')
+            mtutils.increment('sentences_emitted', num_sentences)
+            mtutils.increment('tokens_emitted', num_tokens)
+            mtutils.check_rss()
+
+
+def _preprocess(output_txt_filepath, lowercase, lang, tokenizer,
+                compression, input_source):
+    """Tokenize the content of input_source to a tmp .txt file.
+
+    The tmp .txt file is compressed with compression if set. Return the
+    filepath to the tmp .txt file.
+    """
+    output_filepath = zutils.add_extension(futils.get_output_filepath(
+        sutils.get_xml_filepath(input_source), output_txt_filepath),
+                                           compression)
+    with futils.open_stream(output_filepath, 'w',
+                            compression) as output_stream:
         logger.debug('Writing output to file {}'.format(output_filepath))
-        for json_object in tqdm(wikiextractor.extract(input_xml_filepath)):
-            try:
-                print(tokenize(json_object['text'], lowercase),
-                      file=output_stream)
-            except UnicodeEncodeError as err:
-                logger.error('UnicodeEncodeError processing '
-                             'json_object[\'text\'] with polyglot: {}'
-                             .format(str(err)))
-    return input_xml_filepath
-
-
-def tokenize(raw_text, lowercase):
-    """Tokenize raw_text with polyglot."""
-    output = []
-    try:
-        text = Text(raw_text)
-        for sent in text.sentences:
-            if lowercase:
-                tokens = [token.lower().strip() for token in sent.words]
-            else:
-                tokens = [token.strip() for token in sent.words]
-            output.append(' '.join(tokens))
-    except ValueError as err:
-        logger.debug('Skipping empty text sequence')
-    except pycld2.error as err:
-        logger.debug('{}. Skipping sequence'.format(str(err)))
-    return '\n'.join(output)
+        _tokenize_source(input_source, lowercase, lang, tokenizer,
+                         output_stream)
+    return output_filepath
+
+
+def _get_token_ids_prefix(input_source, output_filepath_prefix):
+    """Return the filepath prefix of the tmp token id corpus of a source."""
+    return os.path.splitext(futils.get_output_filepath(
+        sutils.get_xml_filepath(input_source), output_filepath_prefix))[0]
+
+
+def _preprocess_token_ids(output_filepath_prefix, lowercase, lang, tokenizer,
+                          input_source):
+    """Tokenize the content of input_source to a tmp token id corpus.
+
+    Token ids are local to the tmp corpus, whose vocabulary is saved
+    alongside it. Return the filepath prefix of the tmp corpus.
+    """
+    tmp_filepath_prefix = _get_token_ids_prefix(input_source,
+                                                output_filepath_prefix)
+    with tiutils.TokenIdWriter(tmp_filepath_prefix) as output_stream:
+        logger.debug('Writing token ids to {}'.format(tmp_filepath_prefix))
+        _tokenize_source(input_source, lowercase, lang, tokenizer,
+                         output_stream)
+    return tmp_filepath_prefix
+
+
+def _remap_token_ids(output_filepath_prefix, task):
+    """Write a tmp token id corpus, with global ids, to the output corpus.
+
+    task is a (tmp_filepath_prefix, mapping, (token_offset,
+    sentence_offset)) tuple. The tmp corpus is removed.
+    """
+    tmp_filepath_prefix, mapping, (token_offset, sentence_offset) = task
+    with mtutils.timer('remap'):
+        tiutils.remap(output_filepath_prefix, tmp_filepath_prefix, mapping,
+                      token_offset, sentence_offset)
+    for extension in (tiutils.IDS_EXTENSION, tiutils.OFFSETS_EXTENSION,
+                      tiutils.VOCAB_EXTENSION):
+        os.remove(tmp_filepath_prefix + extension)
+    return tmp_filepath_prefix
+
+
+def _preprocess_shard(lowercase, lang, tokenizer, compression, shard):
+    """Tokenize the content of all input sources of a shard.
+
+    shard is an (output_filepath, input_sources) tuple. Output is written
+    directly to the final shard file, compressed with compression if set.
+    """
+    output_filepath, input_sources = shard
+    with futils.open_stream(output_filepath, 'w',
+                            compression) as output_stream:
+        logger.debug('Writing output to file {}'.format(output_filepath))
+        for input_source in input_sources:
+            _tokenize_source(input_source, lowercase, lang, tokenizer,
+                             output_stream)
+    return output_filepath
+
+
+def _get_process_pool(args, context=multiprocessing):
+    """Return the pool of workers of the process command.
+
+    Workers exceeding the memory budget set by args.max_worker_rss are
+    replaced by new ones.
+    """
+    max_rss = args.max_worker_rss * 1024 * 1024 \
+        if args.max_worker_rss is not None else None
+    return mtutils.WorkerPool(args.num_threads,
+                              (args.profile, 'process', max_rss), context)
+
+
+def _get_shards(input_sources, num_shards, output_dirpath,
+                compression=None):
+    """Split input_sources into num_shards contiguous groups of similar size.
+
+    Return a list of (output_filepath, input_sources) tuples.
+    """
+    return [(zutils.add_extension(
+        futils.get_shard_filepath(output_dirpath, shard_num), compression),
+             shard_sources) for shard_num, shard_sources
+            in enumerate(scutils.partition(input_sources, num_shards))]
+
+
+def _get_shard_size(shard):
+    return sum(scutils.get_task_size(source) for source in shard[1])
+
+
+def _load_manifest(args, manifest_filepath, output_filepaths, input_sources):
+    """Return the manifest entries of an incremental process.
+
+    Stale outputs previously generated from input_sources are removed. Return
+    no entries if the process is not incremental.
+    """
+    if not args.incremental:
+        return {}
+    entries = mutils.load(manifest_filepath)
+    _remove_stale_outputs(manifest_filepath, entries, output_filepaths,
+                          _get_input_filepaths(input_sources))
+    return entries
+
+
+def _remove_empty_dirpath(dirpath):
+    if os.path.isdir(dirpath) and not os.listdir(dirpath):
+        os.rmdir(dirpath)
+
+
+def _process_shards(args, input_sources, settings):
+    shards = _get_shards(input_sources, args.shards, args.wiki_output_filepath,
+                         settings['compress'])
+    manifest_filepath = futils.get_manifest_filepath(
+        args.wiki_output_filepath)
+    entries = _load_manifest(args, manifest_filepath,
+                             [shard[0] for shard in shards], input_sources)
+    todo_shards = _schedule(
+        [shard for shard in shards if not args.incremental
+         or not mutils.is_up_to_date(entries, shard[0], shard[1], settings,
+                                     args.hash)],
+        args.num_threads, key=_get_shard_size)
+    logger.info('Writing {} shards to {}'.format(len(todo_shards),
+                                                 args.wiki_output_filepath))
+    shard_sources = dict(shards)
+    with _get_process_pool(args) as pool:
+        preprocess_shard = functools.partial(
+            _preprocess_shard, args.lower, args.lang, args.tokenizer,
+            settings['compress'])
+        for output_filepath in tqdm(mtutils.collect(pool.imap_unordered(
+                preprocess_shard, todo_shards)), total=len(todo_shards)):
+            if args.incremental:
+                mutils.add_entry(entries, output_filepath,
+                                 shard_sources[output_filepath], settings,
+                                 args.hash)
+                mutils.save(manifest_filepath, entries)
+
+
+def _concatenate_ready(tmp_filepaths, ready_filepaths, num_written,
+                       output_stream, keep, progress):
+    """Append ready tmp files following the num_written first ones.
+
+    tmp files are appended in order, up to the first one which is not
+    ready yet, and removed unless keep is set. Return the number of tmp
+    files written so far.
+    """
+    while num_written < len(tmp_filepaths) \
+            and tmp_filepaths[num_written] in ready_filepaths:
+        tmp_filepath = tmp_filepaths[num_written]
+        with open(tmp_filepath, 'rb') as tmp_stream, \
+                mtutils.timer('concatenate'):
+            shutil.copyfileobj(tmp_stream, output_stream,
+                               futils.COPY_BUFFER_SIZE)
+        if not keep:
+            os.remove(tmp_filepath)
+        num_written += 1
+        progress.update()
+    return num_written
+
+
+def _get_todo_sources(args, input_sources, tmp_filepaths, entries, settings):
+    """Return the scheduled input sources to process and the ready outputs.
+
+    In incremental mode, input sources whose tmp file is up to date are not
+    processed again and their tmp file is ready to be concatenated.
+    """
+    is_done = [args.incremental and mutils.is_up_to_date(
+        entries, tmp_filepath, [input_source], settings, args.hash)
+               for input_source, tmp_filepath
+               in zip(input_sources, tmp_filepaths)]
+    todo_sources = _schedule([input_source for input_source, done
+                              in zip(input_sources, is_done) if not done],
+                             args.num_threads)
+    if len(todo_sources) < len(input_sources):
+        logger.info('Skipping {} archives already processed'
+                    .format(len(input_sources) - len(todo_sources)))
+    ready_filepaths = {tmp_filepath for tmp_filepath, done
+                       in zip(tmp_filepaths, is_done) if done}
+    return todo_sources, ready_filepaths
+
+
+def _process_single_file(args, input_sources, settings):
+    # Workers are handed input sources largest first and return tmp .txt
+    # files as soon as they are done. Tmp files are appended to the output
+    # file in input order, as soon as all the previous ones are, while the
+    # following ones are still being processed. In incremental mode, tmp
+    # files are kept and those which are up to date are not processed
+    # again.
+    # Compressed tmp files are compressed by each worker and concatenated
+    # as is, as concatenated frames, members or streams.
+    tmp_filepaths = [zutils.add_extension(futils.get_output_filepath(
+        sutils.get_xml_filepath(input_source), args.wiki_output_filepath),
+                                          settings['compress'])
+                     for input_source in input_sources]
+    manifest_filepath = futils.get_manifest_filepath(
+        os.path.dirname(tmp_filepaths[0]))
+    entries = _load_manifest(args, manifest_filepath, tmp_filepaths,
+                             input_sources)
+    todo_sources, ready_filepaths = _get_todo_sources(
+        args, input_sources, tmp_filepaths, entries, settings)
+    input_sources_by_tmp_filepath = dict(zip(tmp_filepaths, input_sources))
+    with futils.open_stream(zutils.add_extension(
+            args.wiki_output_filepath, settings['compress']),
+                            'wb') as output_stream, \
+            _get_process_pool(args) as pool:
+        processed_filepaths = mtutils.collect(pool.imap_unordered(
+            functools.partial(_preprocess, args.wiki_output_filepath,
+                              args.lower, args.lang, args.tokenizer,
+                              settings['compress']), todo_sources))
+        with tqdm(total=len(tmp_filepaths)) as progress:
+            num_written = _concatenate_ready(
+                tmp_filepaths, ready_filepaths, 0, output_stream,
+                args.incremental, progress)
+            for tmp_filepath in processed_filepaths:
+                if args.incremental:
+                    mutils.add_entry(
+                        entries, tmp_filepath,
+                        [input_sources_by_tmp_filepath[tmp_filepath]],
+                        settings, args.hash)
+                    mutils.save(manifest_filepath, entries)
+                ready_filepaths.add(tmp_filepath)
+                num_written = _concatenate_ready(
+                    tmp_filepaths, ready_filepaths, num_written,
+                    output_stream, args.incremental, progress)
+    _remove_empty_dirpath(os.path.dirname(tmp_filepaths[0]))
+
+
+def _process_token_ids(args, input_sources):
+    # Workers encode sentences with their own local vocabulary. Local
+    # vocabularies are then merged, and the tmp corpora remapped to global
+    # token ids by the workers, each at its final position in the output.
+    output_filepath_prefix = args.wiki_output_filepath
+    tmp_filepath_prefixes = [
+        _get_token_ids_prefix(input_source, output_filepath_prefix)
+        for input_source in input_sources]
+    with _get_process_pool(args) as pool:
+        preprocess = functools.partial(
+            _preprocess_token_ids, output_filepath_prefix, args.lower,
+            args.lang, args.tokenizer)
+        for _ in tqdm(mtutils.collect(pool.imap_unordered(
+                preprocess, _schedule(input_sources, args.num_threads))),
+                      total=len(input_sources)):
+            pass
+        with mtutils.timer('merge_vocab'):
+            vocab, mappings = tiutils.merge_vocabs(tmp_filepath_prefixes)
+            tiutils.save_vocab(output_filepath_prefix, vocab)
+        logger.info('Saved vocabulary of {} tokens to {}{}'.format(
+            len(vocab), output_filepath_prefix, tiutils.VOCAB_EXTENSION))
+        positions = tiutils.allocate(output_filepath_prefix,
+                                     tmp_filepath_prefixes)
+        remap_token_ids = functools.partial(_remap_token_ids,
+                                            output_filepath_prefix)
+        for _ in tqdm(mtutils.collect(pool.imap_unordered(
+                remap_token_ids, zip(tmp_filepath_prefixes, mappings,
+                                     positions))),
+                      total=len(tmp_filepath_prefixes)):
+            pass
+    _remove_empty_dirpath(os.path.dirname(tmp_filepath_prefixes[0]))
+
+
+def _tokenize_articles(lowercase, lang, tokenizer, raw_texts):
+    """Tokenize a batch of articles of a stdin stream.
+
+    Return the tokenized text of all articles, one sentence per line.
+    """
+    tokenized_texts = [tokenized_text for tokenized_text in tokenize_batch(
+        raw_texts, lowercase, lang, tokenizer) if tokenized_text]
+    num_sentences = sum(tokenized_text.count('\n') + 1
+                        for tokenized_text in tokenized_texts)
+    mtutils.increment('articles_extracted', len(raw_texts))
+    mtutils.increment('sentences_emitted', num_sentences)
+    mtutils.increment('tokens_emitted', num_sentences + sum(
+        tokenized_text.count(' ') for tokenized_text in tokenized_texts))
+    mtutils.check_rss()
+    return ''.join('{}\n'.format(tokenized_text)
+                   for tokenized_text in tokenized_texts)
+
+
+def _iter_article_batches(xml_filepath):
+    """Yield lists of ARTICLES_PER_BATCH raw texts of an XML file."""
+    raw_texts = (json_object['text'] for json_object in mtutils.timed(
+        'wikiextractor', wikiextractor.extract(xml_filepath)))
+    while True:
+        batch = list(itertools.islice(raw_texts, ARTICLES_PER_BATCH))
+        if not batch:
+            return
+        yield batch
+
+
+def _write_article_batch(pending, output_stream, progress):
+    """Write the first pending tokenized batch of a stdin stream."""
+    num_articles, async_result = pending.popleft()
+    for tokenized_text in mtutils.collect([async_result.get()]):
+        with mtutils.timer('write'):
+            output_stream.write(tokenized_text)
+    progress.update(num_articles)
+
+
+def _process_stream(args, settings):
+    # wikiextractor reads the XML content of stdin through a FIFO in the
+    # main process, and batches of articles are tokenized by the workers.
+    # At most 2 batches per worker are in flight, so that the input is
+    # consumed no faster than it is tokenized, and tokenized batches are
+    # written to the output in input order.
+    # Workers are started by a fork server: workers replaced during the
+    # run (see --max-worker-rss) would otherwise be forked from the main
+    # process and inherit the write end of the FIFO, which would then
+    # never reach EOF.
+    if not args.lang:
+        logger.info('No --lang set: language will be detected for each '
+                    'article')
+    with sutils.stream_fifo('-') as xml_filepath, \
+            futils.open_stream(args.wiki_output_filepath, 'w',
+                               settings['compress']) as output_stream, \
+            _get_process_pool(
+                args, multiprocessing.get_context('forkserver')) as pool, \
+            tqdm(unit=' articles') as progress:
+        tokenize_articles = functools.partial(
+            _tokenize_articles, args.lower, args.lang, args.tokenizer)
+        pending = collections.deque()
+        for batch in _iter_article_batches(xml_filepath):
+            pending.append((len(batch), pool.apply_async(
+                tokenize_articles, (batch,))))
+            if len(pending) > 2 * args.num_threads:
+                _write_article_batch(pending, output_stream, progress)
+        while pending:
+            _write_article_batch(pending, output_stream, progress)
+
+
+def _check_process_args(args):
+    if args.max_worker_rss is not None and args.max_worker_rss <= 0:
+        raise InvalidParameterError(
+            'Specified max-worker-rss param should be positive')
+    if args.wiki_input_dirpath == '-' and (args.shards or args.token_ids
+                                           or args.incremental):
+        raise InvalidParameterError(
+            'Reading from stdin cannot be used with --shards, --token-ids or '
+            '--incremental')
+    if args.wiki_output_filepath == '-' and (args.shards or args.token_ids):
+        raise InvalidParameterError(
+            'Writing to stdout cannot be used with --shards or --token-ids')
+    if args.token_ids and (args.shards or args.compress or args.incremental):
+        raise InvalidParameterError(
+            '--token-ids cannot be used with --shards, --compress or '
+            '--incremental')
 
 
 def _process(args):
+    _check_process_args(args)
+    if args.wiki_input_dirpath == '-':
+        logger.info('Processing content of wikipedia XML dump from stdin')
+        _process_stream(args, {'compress': zutils.get_compression(
+            args.wiki_output_filepath, args.compress)})
+        logger.info('Done processing content of Wikipedia dump')
+        return
     logger.info('Processing content of wikipedia archives under {}'
                 .format(args.wiki_input_dirpath))
     if args.lower:
         logger.info('Lowercasing archives')
-    input_filepaths = futils.get_input_filepaths(args.wiki_input_dirpath)
-    total_arxivs = len(input_filepaths)
-    with open(args.wiki_output_filepath, 'w', encoding='utf-8') as output_strm:
-        with multiprocessing.Pool(processes=args.num_threads) as pool:
-            preprocess = functools.partial(
-                _preprocess, args.wiki_output_filepath, args.lower)
-            for _ in tqdm(pool.imap_unordered(preprocess, input_filepaths),
-                          total=total_arxivs):
-                continue
-        # concatenate all .txt files into single output .txt file
-        logger.info('Concatenating tmp files...')
-        tmp_filepaths = futils.get_tmp_filepaths(args.wiki_input_dirpath)
-        for tmp_filepath in tqdm(tmp_filepaths, total=len(tmp_filepaths)):
-            with open(tmp_filepath, 'r', encoding='utf-8') as tmp_stream:
-                for line in tmp_stream:
-                    line = line.strip()
-                    if line:
-                        print(line, file=output_strm)
+    if args.from_bz2:
+        logger.info('Streaming content of .bz2 archives')
+        input_sources = _get_arxiv_chunks(
+            futils.get_bz2_arxivs(args.wiki_input_dirpath), args.num_threads,
+            args.incremental)
+    else:
+        input_sources = futils.get_input_filepaths(args.wiki_input_dirpath)
+    input_sources = futils.natsorted(input_sources,
+                                     key=sutils.get_xml_filepath)
+    if not input_sources:
+        logger.warning('No Wikipedia archive found under {}'
+                       .format(args.wiki_input_dirpath))
+        return
+    if args.token_ids:
+        _process_token_ids(args, input_sources)
         logger.info('Done processing content of Wikipedia archives')
-        shutil.rmtree(futils.get_tmp_dirpath(args.wiki_input_dirpath))
+        return
+    settings = {'lower': args.lower, 'lang': args.lang,
+                'tokenizer': args.tokenizer, 'compress': args.compress}
+    if not args.shards:
+        settings['compress'] = zutils.get_compression(
+            args.wiki_output_filepath, args.compress)
+    if settings['compress']:
+        logger.info('Compressing output with {}'.format(settings['compress']))
+    if args.shards:
+        _process_shards(args, input_sources, settings)
+    else:
+        _process_single_file(args, input_sources, settings)
+    logger.info('Done processing content of Wikipedia archives')
 
 
-def _sample(args):
-    if not 0 < args.percent < 100:
-        raise Exception('Specified percent param should be in ]0, 100[')
-    logger.info('Sampling input file {}'.format(args.input_filepath))
+def _add_metrics_args(parser):
+    parser.add_argument('--metrics', dest='metrics_filepath',
+                        help='absolute path to a file where to save counters '
+                             'and timers of each stage, aggregated across '
+                             'workers')
+    parser.add_argument('--metrics-format', default='json',
+                        choices=mtutils.METRICS_FORMATS,
+                        help='format of the metrics file: JSON or Prometheus '
+                             'text format')
 
-    logger.info('Counting number of lines in file...')
-    if args.input_filepath.endswith('.txt'):
-        input_basename = args.input_filepath.split('.txt')[0]
-    else:
-        input_basename = args.input_filepath
-    with open(args.input_filepath, 'r', encoding='utf-8') as input_stream:
-        count = sum(1 for x in input_stream)
-        logger.info('Total lines = {}'.format(count))
-    final_count = count * args.percent / 100
-    sampling = count / final_count
-    logger.info('Sampling file to {} lines with balance = {}'
-                .format(int(final_count), args.balance))
-    if args.balance:
-        output_filepath = '{}.sample{}.balanced.txt'.format(input_basename,
-                                                            args.percent)
-        with open(args.input_filepath, 'r', encoding='utf-8') as input_stream:
-            with open(output_filepath, 'w', encoding='utf-8') as output_stream:
-                for idx, line in enumerate(input_stream):
-                    if idx % round(sampling) == 0:
-                        print(line.strip(), file=output_stream)
-    else:
-        output_filepath = '{}.sample{}.txt'.format(input_basename,
-                                                   args.percent)
-        with open(args.input_filepath, 'r', encoding='utf-8') as input_stream:
-            with open(output_filepath, 'w', encoding='utf-8') as output_stream:
-                for idx, line in enumerate(input_stream):
-                    if idx >= final_count:
-                        break
-                    print(line.strip(), file=output_stream)
-    logger.info('Done sampling file to {}'.format(output_filepath))
 
+def _add_profile_arg(parser):
+    parser.add_argument('--profile',
+                        help='absolute path to a directory where to save the '
+                             'cProfile stats of each worker')
 
-def main():
-    """Launch WiToKit."""
-    parser = argparse.ArgumentParser(prog='witokit')
-    subparsers = parser.add_subparsers()
+
+def _add_download_parser(subparsers):
     parser_download = subparsers.add_parser(
         'download', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         help='download a given .bz2-compressed Wikipedia XML dump')
@@ -242,8 +682,37 @@ def main():
                                  dest='output_dirpath',
                                  help='absolute path to output directory '
                                       'where to save downloaded files')
-    parser_download.add_argument('-n', '--num-threads', type=int, default=1,
-                                 help='number of CPU threads to use')
+    parser_download.add_argument('-c', '--max-connections', type=int,
+                                 default=3,
+                                 help='maximum number of concurrent '
+                                      'connections to the dump site')
+    parser_download.add_argument('-n', '--num-threads', type=int,
+                                 help='deprecated: alias for '
+                                      '--max-connections')
+    parser_download.add_argument('-m', '--multistream', action='store_true',
+                                 help='whether or not to download multistream '
+                                      'archives and their indexes, which can '
+                                      'be split across CPU threads by extract '
+                                      'and process')
+    parser_download.add_argument('-r', '--max-retries', type=int, default=5,
+                                 help='maximum number of times to retry a '
+                                      'failed download, resuming it from '
+                                      'where it stopped')
+    parser_download.add_argument('--mirror', default=const.WIKI_DL_URL,
+                                 help='base URL of the Wikimedia dump site '
+                                      'or of one of its mirrors')
+    parser_download.add_argument('--cache-dir', dest='cache_dirpath',
+                                 default=dmutils.get_cache_dirpath(),
+                                 help='absolute path to the directory where '
+                                      'to cache the archive lists of dumps')
+    parser_download.add_argument('--no-cache', dest='cache_dirpath',
+                                 action='store_const', const=None,
+                                 help='do not cache the archive lists of '
+                                      'dumps')
+    _add_metrics_args(parser_download)
+
+
+def _add_extract_parser(subparsers):
     parser_extract = subparsers.add_parser(
         'extract', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         help='extract content of Wikipedia .bz2 archives')
@@ -254,6 +723,19 @@ def main():
                                      'Wikipedia .bz2 archives')
     parser_extract.add_argument('-n', '--num-threads', type=int, default=1,
                                 help='number of CPU threads to use')
+    parser_extract.add_argument('--decompress-threads', type=int, default=1,
+                                help='number of threads decompressing the '
+                                     'streams of each multistream archive, '
+                                     'out of --num-threads')
+    parser_extract.add_argument('--hash', action='store_true',
+                                help='whether or not to detect changed '
+                                     'archives by content hash instead of '
+                                     'size and modification time')
+    _add_metrics_args(parser_extract)
+    _add_profile_arg(parser_extract)
+
+
+def _add_process_parser(subparsers):
     parser_process = subparsers.add_parser(
         'process', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         help='(pre-)process content of a Wikipedia XML dump')
@@ -261,26 +743,256 @@ def main():
     parser_process.add_argument('-i', '--input', required=True,
                                 dest='wiki_input_dirpath',
                                 help='absolute path to directory containing '
-                                     'Wikipedia XML files')
+                                     'Wikipedia XML files (or .bz2 archives '
+                                     'with --from-bz2), or - to read an XML '
+                                     'dump, possibly compressed, from stdin')
     parser_process.add_argument('-o', '--output', required=True,
                                 dest='wiki_output_filepath',
-                                help='absolute path to output .txt file')
+                                help='absolute path to output .txt file '
+                                     '(or output directory with --shards), '
+                                     'or - to write to stdout')
     parser_process.add_argument('-l', '--lower', action='store_true',
                                 help='whether or not to lowercase splits')
+    parser_process.add_argument('--lang',
+                                help='the language ISO code of the Wikipedia '
+                                     'dump, used to skip per-article language '
+                                     'detection. Inferred from archive '
+                                     'filenames if not set')
+    parser_process.add_argument('-t', '--tokenizer', default='polyglot',
+                                choices=tokutils.TOKENIZERS,
+                                help='tokenizer backend. icu and regex are '
+                                     'faster than polyglot, regex trading '
+                                     'exactness for speed')
+    parser_process.add_argument('-z', '--from-bz2', action='store_true',
+                                help='whether or not to process .bz2 archives '
+                                     'directly, decompressing them on the '
+                                     'fly without extracting them to disk')
+    parser_process.add_argument('-s', '--shards', type=int,
+                                help='if set, output that number of .txt '
+                                     'shards to the output directory instead '
+                                     'of a single .txt file, avoiding a '
+                                     'second copy of the whole corpus. Use at '
+                                     'least as many shards as threads')
     parser_process.add_argument('-n', '--num-threads', type=int, default=1,
                                 help='number of CPU threads to be used')
+    parser_process.add_argument('-c', '--compress',
+                                choices=zutils.COMPRESSIONS,
+                                help='compress output with zstd, gzip or '
+                                     'bz2. Inferred from the output file '
+                                     'extension (.zst, .gz or .bz2) if not '
+                                     'set')
+    parser_process.add_argument('--token-ids', action='store_true',
+                                help='whether or not to output a binary '
+                                     'corpus of uint32 token ids, with its '
+                                     'vocabulary, to the .ids, .offsets and '
+                                     '.vocab files of the output filepath '
+                                     'prefix instead of a .txt file')
+    parser_process.add_argument('--max-worker-rss', type=int,
+                                help='memory budget of each worker, in MB. '
+                                     'If set, workers exceeding their budget '
+                                     'report it and are replaced after their '
+                                     'current task')
+    parser_process.add_argument('-u', '--incremental', action='store_true',
+                                help='whether or not to keep tokenized '
+                                     'archives in a tmp directory along with '
+                                     'a manifest, so that later runs only '
+                                     'process new, changed or interrupted '
+                                     'archives')
+    parser_process.add_argument('--hash', action='store_true',
+                                help='whether or not to detect changed '
+                                     'archives by content hash instead of '
+                                     'size and modification time')
+    _add_metrics_args(parser_process)
+    _add_profile_arg(parser_process)
+
+
+def _add_sample_parser(subparsers):
     parser_sample = subparsers.add_parser(
         'sample', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        help='sample a given .txt file deterministically')
-    parser_sample.set_defaults(func=_sample)
+        help='sample a given .txt file in a single pass')
+    parser_sample.set_defaults(func=sautils.sample)
     parser_sample.add_argument('-i', '--input', required=True,
                                dest='input_filepath',
-                               help='absolute path to .txt file to sample')
-    parser_sample.add_argument('-p', '--percent', required=True, type=float,
-                               help='percentage of input file to keep')
-    parser_sample.add_argument('-b', '--balance', action='store_true',
-                               help='whether or not to balance the sampling'
-                                    'within the corpus or to take the top'
-                                    'p% sentences')
+                               help='absolute path to .txt file to sample, '
+                                    'or - to read from stdin')
+    parser_sample.add_argument('-o', '--output', dest='output_filepath',
+                               help='absolute path to output .txt file, or - '
+                                    'to write to stdout. Defaults to a '
+                                    'filepath derived from the input filepath')
+    sample_size = parser_sample.add_mutually_exclusive_group(required=True)
+    sample_size.add_argument('-p', '--percent', type=float,
+                             help='percentage of input file to keep')
+    sample_size.add_argument('-l', '--lines', type=int, dest='num_lines',
+                             help='exact number of lines to keep')
+    sample_mode = parser_sample.add_mutually_exclusive_group()
+    sample_mode.add_argument('-b', '--balance', action='store_true',
+                             help='whether or not to balance the sampling '
+                                  'within the corpus or to take the top '
+                                  'p%% sentences')
+    sample_mode.add_argument('-r', '--random', action='store_true',
+                             help='whether or not to sample lines randomly: '
+                                  'Bernoulli sampling with --percent, '
+                                  'reservoir sampling with --lines')
+    parser_sample.add_argument('-s', '--seed', type=int, default=0,
+                               help='seed of random sampling')
+    parser_sample.add_argument('-c', '--compress',
+                               choices=zutils.COMPRESSIONS,
+                               help='compress output with zstd, gzip or bz2. '
+                                    'Inferred from the output file extension '
+                                    '(.zst, .gz or .bz2) if not set, or else '
+                                    'from the input file extension. '
+                                    'Compressed input is detected and '
+                                    'decompressed automatically')
+    parser_sample.add_argument('-x', '--index', action='store_true',
+                               help='whether or not to build (once) and use '
+                                    'a line-offset index of the input file '
+                                    'to seek to sampled lines instead of '
+                                    'scanning the whole file')
+
+
+def _add_bench_parser(subparsers):
+    parser_bench = subparsers.add_parser(
+        'bench', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help='benchmark each stage of the pipeline on a synthetic dump')
+    parser_bench.set_defaults(func=_bench)
+    parser_bench.add_argument('-o', '--output', dest='output_filepath',
+                              default='-',
+                              help='absolute path to output .json file, or '
+                                   '- to write to stdout')
+    parser_bench.add_argument('-d', '--dirpath',
+                              help='absolute path to the directory where to '
+                                   'generate the synthetic dump, kept after '
+                                   'the benchmark. Defaults to a tmp '
+                                   'directory')
+    parser_bench.add_argument('-s', '--size', type=int, default=100,
+                              help='size of the uncompressed synthetic dump '
+                                   'in MB')
+    parser_bench.add_argument('-a', '--arxivs', type=int, default=1,
+                              dest='num_arxivs',
+                              help='number of .bz2 archives to split the '
+                                   'synthetic dump into')
+    parser_bench.add_argument('-l', '--lang', default='en',
+                              help='language ISO code of the synthetic dump, '
+                                   'which determines its script')
+    parser_bench.add_argument('--lower', action='store_true',
+                              help='whether or not to lowercase splits')
+    parser_bench.add_argument('-t', '--tokenizer', default='polyglot',
+                              choices=tokutils.TOKENIZERS,
+                              help='tokenizer backend to benchmark')
+    parser_bench.add_argument('-n', '--num-threads', type=int, default=1,
+                              help='number of CPU threads to be used for '
+                                   'end-to-end processing')
+    parser_bench.add_argument('--seed', type=int, default=0,
+                              help='seed of the synthetic dump generator')
+
+
+def _add_batch_parser(subparsers):
+    parser_batch = subparsers.add_parser(
+        'batch', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help='download and process the dumps of several Wikipedias in a '
+             'single run')
+    parser_batch.set_defaults(func=_batch)
+    batch_wikis = parser_batch.add_mutually_exclusive_group(required=True)
+    batch_wikis.add_argument('-l', '--langs', nargs='+',
+                             help='the language ISO codes of the Wikipedia '
+                                  'dumps to download and process')
+    batch_wikis.add_argument('-f', '--config',
+                             help='absolute path to a YAML config file '
+                                  'listing langs and overriding other '
+                                  'arguments')
+    parser_batch.add_argument('-d', '--date', default='latest',
+                              help='the date of the Wikipedia dumps')
+    parser_batch.add_argument('-o', '--output', dest='output_dirpath',
+                              help='absolute path to output directory where '
+                                   'to save archives and .txt files')
+    parser_batch.add_argument('--lower', action='store_true',
+                              help='whether or not to lowercase splits')
+    parser_batch.add_argument('-t', '--tokenizer', default='polyglot',
+                              choices=tokutils.TOKENIZERS,
+                              help='tokenizer backend')
+    parser_batch.add_argument('--compress', choices=zutils.COMPRESSIONS,
+                              help='compress output with zstd, gzip or bz2')
+    parser_batch.add_argument('-m', '--multistream', action='store_true',
+                              help='whether or not to download multistream '
+                                   'archives, which can be split across CPU '
+                                   'threads')
+    parser_batch.add_argument('-c', '--max-connections', type=int, default=3,
+                              help='maximum number of concurrent connections '
+                                   'to the dump site, shared by all wikis')
+    parser_batch.add_argument('-r', '--max-retries', type=int, default=5,
+                              help='maximum number of times to retry a '
+                                   'failed download')
+    parser_batch.add_argument('--mirror', default=const.WIKI_DL_URL,
+                              help='base URL of the Wikimedia dump site or of '
+                                   'one of its mirrors')
+    parser_batch.add_argument('--cache-dir', dest='cache_dirpath',
+                              default=dmutils.get_cache_dirpath(),
+                              help='absolute path to the directory where to '
+                                   'cache the archive lists of dumps')
+    parser_batch.add_argument('--no-cache', dest='cache_dirpath',
+                              action='store_const', const=None,
+                              help='do not cache the archive lists of dumps')
+    parser_batch.add_argument('-n', '--num-threads', type=int, default=1,
+                              help='number of CPU threads to be used, shared '
+                                   'by all wikis')
+    _add_metrics_args(parser_batch)
+
+
+def _add_dedup_parser(subparsers):
+    parser_dedup = subparsers.add_parser(
+        'dedup', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help='filter and remove duplicate lines of a given .txt file')
+    parser_dedup.set_defaults(func=ddutils.dedup)
+    parser_dedup.add_argument('-i', '--input', required=True,
+                              dest='input_filepath',
+                              help='absolute path to .txt file to '
+                                   'deduplicate')
+    parser_dedup.add_argument('-o', '--output', required=True,
+                              dest='output_filepath',
+                              help='absolute path to output .txt file, or - '
+                                   'to write to stdout')
+    parser_dedup.add_argument('-d', '--dedup', choices=ddutils.DEDUP_MODES,
+                              default='exact',
+                              help='remove exact duplicate lines, or also '
+                                   'near-duplicate lines with MinHash LSH '
+                                   '(requires numpy)')
+    parser_dedup.add_argument('--min-tokens', type=int,
+                              help='remove lines with fewer tokens')
+    parser_dedup.add_argument('--max-tokens', type=int,
+                              help='remove lines with more tokens')
+    parser_dedup.add_argument('--lang',
+                              help='the language ISO code of the input file, '
+                                   'checked by --min-lang-confidence')
+    parser_dedup.add_argument('--min-lang-confidence', type=float,
+                              help='remove lines whose percentage of text in '
+                                   '--lang (or in their most likely language) '
+                                   'detected by pycld2 is lower')
+    parser_dedup.add_argument('-c', '--compress', choices=zutils.COMPRESSIONS,
+                              help='compress output with zstd, gzip or bz2. '
+                                   'Inferred from the output file extension '
+                                   '(.zst, .gz or .bz2) if not set')
+    parser_dedup.add_argument('-n', '--num-threads', type=int, default=1,
+                              help='number of CPU threads to be used')
+    parser_dedup.add_argument('--max-memory', type=int, default=1024,
+                              help='memory budget of each worker for the '
+                                   'deduplication index, in MB')
+    _add_metrics_args(parser_dedup)
+
+
+def main():
+    """Launch WiToKit."""
+    parser = argparse.ArgumentParser(prog='witokit')
+    subparsers = parser.add_subparsers()
+    _add_download_parser(subparsers)
+    _add_extract_parser(subparsers)
+    _add_process_parser(subparsers)
+    _add_sample_parser(subparsers)
+    _add_bench_parser(subparsers)
+    _add_batch_parser(subparsers)
+    _add_dedup_parser(subparsers)
     args = parser.parse_args()
-    args.func(args)
+    with mtutils.timer('command'):
+        args.func(args)
+    if getattr(args, 'metrics_filepath', None):
+        mtutils.save(args.metrics_filepath, args.metrics_format)
+        logger.info('Saved metrics to {}'.format(args.metrics_filepath))
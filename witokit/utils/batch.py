@@ -0,0 +1,223 @@
+"""Batch utils.
+
+Methods used to download and process the dumps of several Wikipedias in a
+single run. All wikis share the same download connections and the same
+pool of workers: archives of all wikis are downloaded alternately, and
+split into chunks tokenized as soon as they are downloaded. Once all the
+chunks of a wiki are tokenized, they are concatenated to its output file.
+"""
+
+import os
+import math
+import shutil
+import logging
+import functools
+import itertools
+import collections
+import urllib.error
+import multiprocessing
+
+from tqdm import tqdm
+
+import witokit.utils.compression as zutils
+import witokit.utils.config as cutils
+import witokit.utils.downloads as dutils
+import witokit.utils.dumps as dmutils
+import witokit.utils.files as futils
+import witokit.utils.metrics as mtutils
+import witokit.utils.scheduler as scutils
+import witokit.utils.streams as sutils
+import witokit.utils.urls as uutils
+
+from witokit.exceptions.parameter import InvalidParameterError
+
+__all__ = ('batch',)
+
+logger = logging.getLogger(__name__)
+
+# Batch config keys whose argument dest is not the key itself
+CONFIG_DESTS = {'output': 'output_dirpath', 'cache-dir': 'cache_dirpath'}
+# Flags storing a constant to another dest, as (dest, const)
+CONFIG_CONSTS = {'no-cache': ('cache_dirpath', None)}
+
+
+def _get_wikis(args):
+    """Return the list of (lang, date) wikis of a batch.
+
+    Wikis are read from args.langs or from the YAML config file
+    args.config, whose other keys override command line arguments.
+    """
+    if not args.config:
+        return [(lang, args.date) for lang in args.langs]
+    config = cutils.load(args.config)
+    for key, value in config.items():
+        if key == 'langs':
+            continue
+        if key in CONFIG_CONSTS:
+            if value:
+                setattr(args, *CONFIG_CONSTS[key])
+            continue
+        dest = CONFIG_DESTS.get(key, key.replace('-', '_'))
+        if dest in ('config', 'langs', 'func') or not hasattr(args, dest):
+            raise InvalidParameterError(
+                'Unsupported batch config key \'{}\''.format(key))
+        setattr(args, dest, value)
+    if 'langs' not in config:
+        raise InvalidParameterError('Batch config should define langs')
+    # langs are either language codes or {lang: xx, date: yyyymmdd} dicts
+    return [(wiki, args.date) if isinstance(wiki, str)
+            else (wiki['lang'], str(wiki.get('date', args.date)))
+            for wiki in config['langs']]
+
+
+def _get_downloads(args, wikis):
+    """Return the downloads of all wikis and the wiki of each download.
+
+    Downloads are interleaved across wikis so that small wikis are
+    downloaded, and processed, alongside large ones.
+    """
+    wiki_downloads = []
+    for lang, date in wikis:
+        wiki_dump_url = uutils.get_wikipedia_dump_url(lang, date, args.mirror)
+        try:
+            dump_files = dmutils.get_dump_files(
+                wiki_dump_url, lang, date, args.multistream,
+                args.cache_dirpath)
+        except urllib.error.HTTPError:
+            logger.error('Skipping {}wiki-{}'.format(lang, date))
+            continue
+        dmutils.log_download_plan(dump_files, wiki_dump_url)
+        arxiv_dirpath = os.path.join(args.output_dirpath,
+                                     '{}wiki-{}'.format(lang, date))
+        wiki_downloads.append(((lang, date), dmutils.get_downloads(
+            dump_files, wiki_dump_url, arxiv_dirpath)))
+    downloads = [download for downloads in itertools.zip_longest(
+        *[downloads for _, downloads in wiki_downloads])
+                 for download in downloads if download]
+    return downloads, {download[1]: wiki for wiki, downloads in wiki_downloads
+                       for download in downloads}
+
+
+def _get_output_filepath(args, lang, date):
+    return zutils.add_extension(
+        os.path.join(args.output_dirpath, '{}wiki-{}.txt'.format(lang, date)),
+        args.compress)
+
+
+def _get_todo_wikis(args, wikis):
+    """Return the (lang, date) wikis of a batch which are not processed yet.
+
+    'latest' dates are resolved, so that outputs are named after the actual
+    date of the dump and processed again once a new dump is published.
+    """
+    todo_wikis = []
+    for lang, date in wikis:
+        date = dmutils.resolve_date(
+            uutils.get_wikipedia_dump_url(lang, date, args.mirror), lang,
+            date, args.cache_dirpath)
+        if date != 'latest' and os.path.exists(
+                _get_output_filepath(args, lang, date)):
+            logger.info('Skipping {}wiki-{}: already processed'
+                        .format(lang, date))
+        else:
+            todo_wikis.append((lang, date))
+    return todo_wikis
+
+
+def _finish_wiki(output_filepath, async_results):
+    """Concatenate the tmp files of a wiki, in order, to output_filepath.
+
+    Files are concatenated to a .part file moved to output_filepath once
+    complete, so that interrupted wikis are processed again on next run.
+    """
+    tmp_filepaths = futils.natsorted(
+        mtutils.collect(async_result.get() for async_result in async_results))
+    part_filepath = '{}.part'.format(output_filepath)
+    with open(part_filepath, 'wb') as output_stream:
+        for tmp_filepath in tmp_filepaths:
+            with open(tmp_filepath, 'rb') as tmp_stream, \
+                    mtutils.timer('concatenate'):
+                shutil.copyfileobj(tmp_stream, output_stream,
+                                   futils.COPY_BUFFER_SIZE)
+            os.remove(tmp_filepath)
+    os.replace(part_filepath, output_filepath)
+    tmp_dirpath = os.path.dirname(tmp_filepaths[0]) if tmp_filepaths else None
+    if tmp_dirpath and not os.listdir(tmp_dirpath):
+        os.rmdir(tmp_dirpath)
+    logger.info('Saved {}'.format(output_filepath))
+
+
+def _submit_arxiv(pool, preprocess, arxiv):
+    """Submit the chunks of a downloaded archive to the pool of workers.
+
+    Return the list of the AsyncResults of the chunks.
+    """
+    if 'multistream-index' in os.path.basename(arxiv):
+        return []
+    num_chunks = math.ceil(os.path.getsize(arxiv) / scutils.MAX_CHUNK_SIZE)
+    return [pool.apply_async(mtutils.run_task, (preprocess, chunk))
+            for chunk in sutils.split_arxiv(arxiv, num_chunks)]
+
+
+def _finish_done_wikis(args, num_downloads, async_results):
+    """Finish the wikis whose archives are all downloaded and processed."""
+    for wiki in [wiki for wiki, num in num_downloads.items()
+                 if not num and all(async_result.ready() for async_result
+                                    in async_results[wiki])]:
+        _finish_wiki(_get_output_filepath(args, *wiki),
+                     async_results.pop(wiki))
+        del num_downloads[wiki]
+
+
+def batch(args, preprocess):
+    """Download and process the dumps of several wikis.
+
+    args holds the arguments of the batch command. preprocess is the
+    function tokenizing an ArxivChunk to a tmp .txt file, called with
+    (output_txt_filepath, lowercase, lang, tokenizer, compression, chunk).
+    """
+    wikis = _get_wikis(args)
+    if not args.output_dirpath:
+        raise InvalidParameterError('Batch output directory is not defined')
+    if args.compress:
+        zutils.check_compression(args.compress)
+    downloads, download_wikis = _get_downloads(
+        args, _get_todo_wikis(args, wikis))
+    num_downloads = collections.Counter(download_wikis.values())
+    async_results = collections.defaultdict(list)
+    failed_wikis = set()
+
+    def _skip_wiki(download, error):
+        wiki = download_wikis[download[1]]
+        if wiki not in failed_wikis:
+            logger.error('Skipping {}wiki-{}: {}'.format(wiki[0], wiki[1],
+                                                         error))
+            failed_wikis.add(wiki)
+            del num_downloads[wiki]
+            async_results.pop(wiki, None)
+    logger.info('Downloading and processing {} archives of {} wikis'
+                .format(len(downloads), len(num_downloads)))
+    # The pool is started before the download threads, and fed with the
+    # chunks of each archive as soon as it is downloaded
+    with multiprocessing.Pool(args.num_threads,
+                              initializer=mtutils.init_worker,
+                              initargs=(None, 'batch')) as pool, \
+            dutils.DownloadEngine(args.max_connections,
+                                  args.max_retries) as engine:
+        for arxiv in tqdm(engine.download_all(downloads, _skip_wiki),
+                          total=len(downloads)):
+            wiki = download_wikis[arxiv]
+            if wiki in failed_wikis:
+                continue
+            num_downloads[wiki] -= 1
+            async_results[wiki].extend(_submit_arxiv(pool, functools.partial(
+                preprocess, None, args.lower, wiki[0], args.tokenizer,
+                args.compress), arxiv))
+            _finish_done_wikis(args, num_downloads, async_results)
+        mtutils.increment('downloaded_files', engine.files_downloaded)
+        mtutils.increment('downloaded_bytes', engine.bytes_downloaded)
+        for wiki in sorted(num_downloads, key=lambda x: len(async_results[x])):
+            _finish_wiki(_get_output_filepath(args, *wiki),
+                         async_results.pop(wiki))
+    logger.info('Done processing {} wikis'.format(
+        len(set(download_wikis.values())) - len(failed_wikis)))
@@ -0,0 +1,338 @@
+"""Benchmark utils.
+
+Methods used to generate synthetic multistream .bz2 Wikipedia XML dumps of
+configurable size and language, and to measure the resources used by each
+stage of the pipeline.
+"""
+
+import os
+import bz2
+import json
+import time
+import random
+import shutil
+import argparse
+import logging
+import tempfile
+import multiprocessing
+
+import wikiextractor
+
+from witokit.exceptions.parameter import InvalidParameterError
+
+import witokit.utils.files as futils
+import witokit.utils.metrics as mtutils
+import witokit.utils.streams as sutils
+import witokit.utils.tokenizers as tokutils
+
+__all__ = ('generate_dump', 'get_stage_stats', 'bench')
+
+logger = logging.getLogger(__name__)
+
+PAGES_PER_STREAM = 100
+
+SCRIPTS = {
+    'latin': 'abcdefghijklmnopqrstuvwxyz',
+    'cyrillic': 'абвгдежзийклмнопрстуфхцчшщыэюя',
+    'greek': 'αβγδεζηθικλμνξοπρστυφχψω',
+    'arabic': 'ابتثجحخدذرزسشصضطظعغفقكلمنهوي',
+    'devanagari': 'कखगघचछजझटठडढणतथदधनपफबभमयरलवशसह',
+    'cjk': ''.join(chr(code) for code in range(0x4e00, 0x4e00 + 500))}
+
+LANG_SCRIPTS = {
+    'ru': 'cyrillic', 'uk': 'cyrillic', 'bg': 'cyrillic', 'sr': 'cyrillic',
+    'el': 'greek', 'ar': 'arabic', 'fa': 'arabic', 'ur': 'arabic',
+    'hi': 'devanagari', 'mr': 'devanagari', 'ne': 'devanagari',
+    'zh': 'cjk', 'ja': 'cjk'}
+
+# Scripts written without spaces between words
+UNSPACED_SCRIPTS = ('cjk',)
+
+SITEINFO = '''<mediawiki xml:lang="{}">
+  <siteinfo>
+    <sitename>Wikipedia</sitename>
+    <dbname>{}wiki</dbname>
+  </siteinfo>
+'''
+
+PAGE = '''  <page>
+    <title>{title}</title>
+    <ns>0</ns>
+    <id>{page_id}</id>
+    <revision>
+      <text xml:space="preserve">{text}</text>
+    </revision>
+  </page>
+'''
+
+
+def _get_sentence_pool(lang, rng, num_sentences=2000):
+    script = LANG_SCRIPTS.get(lang, 'latin')
+    alphabet = SCRIPTS[script]
+    words = [''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 9)))
+             for _ in range(5000)]
+    separator = '' if script in UNSPACED_SCRIPTS else ' '
+    end_marks = ('。',) if script in UNSPACED_SCRIPTS else ('.', '.', '!', '?')
+    sentences = []
+    for _ in range(num_sentences):
+        sent_words = rng.sample(words, rng.randint(4, 25))
+        sent_words[rng.randrange(len(sent_words))] = '[[{}]]'.format(
+            rng.choice(words))
+        sent_words[rng.randrange(len(sent_words))] = "'''{}'''".format(
+            rng.choice(words))
+        sentences.append(separator.join(sent_words) + rng.choice(end_marks))
+    return sentences, words
+
+
+def _get_page(page_id, sentences, words, rng):
+    paragraphs = []
+    for num in range(rng.randint(1, 6)):
+        if num:
+            paragraphs.append('== {} =='.format(rng.choice(words)))
+        paragraphs.append(' '.join(rng.choice(sentences)
+                                   for _ in range(rng.randint(1, 10))))
+    return PAGE.format(title=rng.choice(words).capitalize(), page_id=page_id,
+                       text='\n\n'.join(paragraphs).replace('&', '&amp;')
+                       .replace('<', '&lt;').replace('>', '&gt;'))
+
+
+def _write_index(index_filepath, index):
+    with bz2.open(index_filepath, 'wt', encoding='utf-8') as index_stream:
+        index_stream.writelines(index)
+
+
+def _write_arxiv(arxiv_filepath, index_filepath, lang, size, first_page_id,
+                 sentences, words, rng):
+    """Write a multistream archive of about size bytes of XML.
+
+    Return the number of pages written.
+    """
+    page_id = first_page_id
+    written = 0
+    index = []
+    with open(arxiv_filepath, 'wb') as arxiv_stream:
+        arxiv_stream.write(bz2.compress(
+            SITEINFO.format(lang, lang).encode('utf-8')))
+        while written < size:
+            offset = arxiv_stream.tell()
+            pages = []
+            for _ in range(PAGES_PER_STREAM):
+                index.append('{offset}:{page_id}:P{page_id}\n'.format(
+                    offset=offset, page_id=page_id))
+                pages.append(_get_page(page_id, sentences, words, rng))
+                page_id += 1
+            data = ''.join(pages).encode('utf-8')
+            written += len(data)
+            arxiv_stream.write(bz2.compress(data))
+        arxiv_stream.write(bz2.compress(b'</mediawiki>\n'))
+    _write_index(index_filepath, index)
+    return page_id - first_page_id
+
+
+def generate_dump(output_dirpath, lang='en', size_mb=100, num_arxivs=1,
+                  seed=0):
+    """Generate a synthetic multistream dump under output_dirpath.
+
+    Write num_arxivs multistream .bz2 archives (with their index) holding
+    about size_mb MB of XML in total, named after the archives of real
+    dumps. Pages contain random words written in the script of lang, with
+    some wiki markup. Return the list of archive filepaths and the total
+    number of pages.
+    """
+    os.makedirs(output_dirpath, exist_ok=True)
+    rng = random.Random(seed)
+    sentences, words = _get_sentence_pool(lang, rng)
+    arxiv_size = size_mb * 1024 * 1024 / num_arxivs
+    arxivs = []
+    num_pages = 0
+    for num in range(1, num_arxivs + 1):
+        first_page_id = num_pages + 1
+        arxiv_filepath = os.path.join(
+            output_dirpath, '{}wiki-bench-pages-articles-multistream{}.xml'
+            '-p{}.bz2'.format(lang, num, first_page_id))
+        index_filepath = os.path.join(
+            output_dirpath, '{}wiki-bench-pages-articles-multistream-index{}'
+            '.txt-p{}.bz2'.format(lang, num, first_page_id))
+        logger.info('Generating synthetic archive {}'.format(arxiv_filepath))
+        num_pages += _write_arxiv(arxiv_filepath, index_filepath, lang,
+                                  arxiv_size, first_page_id, sentences,
+                                  words, rng)
+        arxivs.append(arxiv_filepath)
+    return arxivs, num_pages
+
+
+def get_stage_stats(start_time, num_bytes, num_articles=None):
+    """Return throughput and peak RSS of a stage started at start_time.
+
+    num_bytes is the size of the uncompressed data handled by the stage,
+    used to compute its throughput in MB/s.
+    """
+    seconds = time.perf_counter() - start_time
+    stats = {'seconds': round(seconds, 3),
+             'bytes': num_bytes,
+             'mb_per_s': (round(num_bytes / 1024 / 1024 / seconds, 3)
+                          if seconds else None),
+             'peak_rss_mb': round(
+                 mtutils.get_peak_rss(children=True) / 1024 / 1024, 1)}
+    if num_articles is not None:
+        stats['articles'] = num_articles
+        stats['articles_per_s'] = round(num_articles / seconds, 1) \
+            if seconds else None
+    return stats
+
+
+def _get_process_args(input_dirpath, output_filepath, num_threads, lowercase,
+                      lang, tokenizer):
+    """Return the args of a process command streaming .bz2 archives."""
+    return argparse.Namespace(
+        wiki_input_dirpath=input_dirpath, wiki_output_filepath=output_filepath,
+        num_threads=num_threads, lower=lowercase, lang=lang,
+        tokenizer=tokenizer, from_bz2=True, shards=None, compress=None,
+        incremental=False, hash=False, profile=None, max_worker_rss=None,
+        token_ids=False)
+
+
+def _bench_decompress(arxivs, num_articles):
+    start_time = time.perf_counter()
+    num_bytes = 0
+    for arxiv in arxivs:
+        xml_filepath = arxiv.rsplit('.bz2')[0]
+        with open(xml_filepath, 'wb') as xml_stream:
+            for data in sutils.iter_decompressed(arxiv):
+                xml_stream.write(data)
+        num_bytes += os.path.getsize(xml_filepath)
+    return get_stage_stats(start_time, num_bytes, num_articles)
+
+
+def _bench_extract(xml_filepaths):
+    # Extracted texts are saved as json lines for the tokenize stage
+    start_time = time.perf_counter()
+    num_articles = 0
+    for xml_filepath in xml_filepaths:
+        with open('{}.json'.format(xml_filepath), 'w',
+                  encoding='utf-8') as texts_stream:
+            for json_object in wikiextractor.extract(xml_filepath):
+                print(json.dumps(json_object['text']), file=texts_stream)
+                num_articles += 1
+    return get_stage_stats(
+        start_time, sum(os.path.getsize(xml_filepath)
+                        for xml_filepath in xml_filepaths), num_articles)
+
+
+def _bench_tokenize(xml_filepaths, lowercase, lang, tokenizer):
+    start_time = time.perf_counter()
+    num_bytes = 0
+    num_articles = 0
+    for xml_filepath in xml_filepaths:
+        with open('{}.json'.format(xml_filepath), 'r',
+                  encoding='utf-8') as texts_stream, \
+                open('{}.txt'.format(xml_filepath), 'w',
+                     encoding='utf-8') as output_stream:
+            raw_texts = [json.loads(line) for line in texts_stream]
+            num_bytes += sum(len(raw_text.encode('utf-8'))
+                             for raw_text in raw_texts)
+            num_articles += len(raw_texts)
+            for tokenized_text in tokutils.tokenize_batch(
+                    raw_texts, lowercase, lang, tokenizer):
+                if tokenized_text:
+                    print(tokenized_text, file=output_stream)
+    return get_stage_stats(start_time, num_bytes, num_articles)
+
+
+def _bench_concatenate(xml_filepaths, output_filepath):
+    start_time = time.perf_counter()
+    with open(output_filepath, 'wb') as output_stream:
+        for xml_filepath in xml_filepaths:
+            with open('{}.txt'.format(xml_filepath), 'rb') as tmp_stream:
+                shutil.copyfileobj(tmp_stream, output_stream,
+                                   futils.COPY_BUFFER_SIZE)
+    return get_stage_stats(start_time, os.path.getsize(output_filepath))
+
+
+def _bench_process(process, process_args, num_bytes, num_articles):
+    start_time = time.perf_counter()
+    process(process_args)
+    return get_stage_stats(start_time, num_bytes, num_articles)
+
+
+def _send_stage_stats(sender, stage, stage_args):
+    sender.send(stage(*stage_args))
+    sender.close()
+
+
+def _run_stage(stage, *stage_args):
+    """Run a benchmark stage in a new process and return its stats.
+
+    Each stage runs in its own (non-daemonic, so that it can start a pool
+    of workers) process so that peak RSS is measured per stage.
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_send_stage_stats,
+                                      args=(sender, stage, stage_args))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    except EOFError:
+        raise RuntimeError('Benchmark stage {} failed'.format(
+            stage.__name__)) from None
+    finally:
+        process.join()
+
+
+def bench(args, process):
+    """Benchmark each stage of the pipeline on a synthetic dump.
+
+    process is the function running the process command, used to
+    benchmark end-to-end processing.
+    """
+    if args.size <= 0 or args.num_arxivs <= 0:
+        raise InvalidParameterError(
+            'Specified size and arxivs params should be positive')
+    dirpath = args.dirpath or tempfile.mkdtemp(prefix='witokit-bench-')
+    try:
+        start_time = time.perf_counter()
+        arxivs, num_articles = generate_dump(
+            dirpath, args.lang, args.size, args.num_arxivs, args.seed)
+        generation_seconds = time.perf_counter() - start_time
+        compressed_size = sum(os.path.getsize(arxiv) for arxiv in arxivs)
+        xml_filepaths = [arxiv.rsplit('.bz2')[0] for arxiv in arxivs]
+        stages = {}
+        logger.info('Benchmarking decompression')
+        stages['decompress'] = _run_stage(_bench_decompress, arxivs,
+                                          num_articles)
+        xml_size = stages['decompress']['bytes']
+        logger.info('Benchmarking extraction')
+        stages['extract'] = _run_stage(_bench_extract, xml_filepaths)
+        logger.info('Benchmarking tokenization')
+        stages['tokenize'] = _run_stage(_bench_tokenize, xml_filepaths,
+                                        args.lower, args.lang, args.tokenizer)
+        logger.info('Benchmarking concatenation')
+        stages['concatenate'] = _run_stage(
+            _bench_concatenate, xml_filepaths,
+            os.path.join(dirpath, 'concatenated.txt'))
+        logger.info('Benchmarking end-to-end processing with {} threads'
+                    .format(args.num_threads))
+        for xml_filepath in xml_filepaths:
+            for filepath in (xml_filepath, '{}.json'.format(xml_filepath),
+                             '{}.txt'.format(xml_filepath)):
+                os.remove(filepath)
+        stages['end_to_end'] = _run_stage(
+            _bench_process, process, _get_process_args(
+                dirpath, os.path.join(dirpath, 'processed.txt'),
+                args.num_threads, args.lower, args.lang, args.tokenizer),
+            xml_size, num_articles)
+    finally:
+        if not args.dirpath:
+            shutil.rmtree(dirpath)
+    results = {
+        'dump': {'lang': args.lang, 'arxivs': len(arxivs),
+                 'compressed_bytes': compressed_size,
+                 'bytes': xml_size, 'articles': num_articles,
+                 'generation_seconds': round(generation_seconds, 3)},
+        'num_threads': args.num_threads, 'tokenizer': args.tokenizer,
+        'lower': args.lower, 'stages': stages}
+    with futils.open_stream(args.output_filepath, 'w') as output_stream:
+        json.dump(results, output_stream, indent=2)
+        print(file=output_stream)
+    logger.info('Done benchmarking')
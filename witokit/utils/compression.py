@@ -0,0 +1,118 @@
+"""Compression utils.
+
+Methods used to read and write zstd, gzip or bz2 compressed streams.
+
+All three formats support concatenation: a sequence of zstd frames, gzip
+members or bz2 streams is itself a valid compressed file. Workers can thus
+compress their own output in parallel, and compressed outputs can be
+concatenated as is. zstd support requires the zstandard package.
+"""
+
+import io
+import re
+import bz2
+import gzip
+
+from witokit.exceptions.parameter import InvalidParameterError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ('COMPRESSIONS', 'EXTENSIONS', 'check_compression',
+           'get_compression', 'add_extension', 'detect_compression',
+           'wrap_stream')
+
+COMPRESSIONS = ('zstd', 'gzip', 'bz2')
+
+EXTENSIONS = {'zstd': '.zst', 'gzip': '.gz', 'bz2': '.bz2'}
+
+# gzip level 9 is several times slower for marginal gains
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+MAGIC_PATTERNS = {
+    'zstd': re.compile(re.escape(b'\x28\xb5\x2f\xfd')),
+    'gzip': re.compile(re.escape(b'\x1f\x8b')),
+    'bz2': re.compile(b'BZh[1-9]1AY&SY')}
+
+
+def _check_zstandard():
+    if zstandard is None:
+        raise InvalidParameterError('zstd compression requires zstandard')
+
+
+def check_compression(compression):
+    """Raise an InvalidParameterError if compression is not supported.
+
+    zstd compression is only supported if zstandard is installed.
+    """
+    if compression not in COMPRESSIONS:
+        raise InvalidParameterError(
+            'Unsupported compression \'{}\'. Should be one of {}'
+            .format(compression, COMPRESSIONS))
+    if compression == 'zstd':
+        _check_zstandard()
+
+
+def get_compression(filepath, compression=None):
+    """Return the compression of filepath.
+
+    Return compression if set, else the compression matching the extension
+    of filepath, or None if filepath is not compressed.
+    """
+    if compression:
+        check_compression(compression)
+        return compression
+    for name, extension in EXTENSIONS.items():
+        if filepath.endswith(extension):
+            return name
+    return None
+
+
+def add_extension(filepath, compression):
+    """Append the extension of compression to filepath if missing."""
+    if not compression or filepath == '-' \
+            or filepath.endswith(EXTENSIONS[compression]):
+        return filepath
+    return '{}{}'.format(filepath, EXTENSIONS[compression])
+
+
+def detect_compression(stream):
+    """Return the compression of a buffered binary stream, or None.
+
+    The compression is detected from the magic bytes at the beginning of
+    the stream, which are peeked at without being consumed.
+    """
+    head = stream.peek(10)[:10]
+    for name, pattern in MAGIC_PATTERNS.items():
+        if pattern.match(head):
+            return name
+    return None
+
+
+def wrap_stream(stream, mode, compression):
+    """Return a binary stream (de)compressing the binary stream stream.
+
+    Data written to the returned stream is compressed and written to
+    stream, data read is read from stream and decompressed. Closing the
+    returned stream does not close stream.
+    """
+    if compression == 'gzip':
+        if 'r' in mode:
+            return gzip.GzipFile(fileobj=stream, mode='rb')
+        return gzip.GzipFile(fileobj=stream, mode='wb',
+                             compresslevel=GZIP_LEVEL)
+    if compression == 'bz2':
+        return bz2.BZ2File(stream, 'rb' if 'r' in mode else 'wb')
+    if compression == 'zstd':
+        _check_zstandard()
+        if 'r' in mode:
+            return io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(
+                    stream, read_across_frames=True, closefd=False))
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+            stream, closefd=False)
+    raise InvalidParameterError('Unsupported compression \'{}\'. Should be '
+                                'one of {}'.format(compression, COMPRESSIONS))
@@ -0,0 +1,464 @@
+"""Deduplication utils.
+
+Methods used to filter the lines of a tokenized .txt file by length and
+language confidence, and to remove exact and near-duplicate lines.
+
+Deduplication runs in passes over a partitioned index, so that the
+memory used by each worker is bounded:
+1. the input file is split into byte ranges of whole lines. For each line
+   of a range, filters are applied and the keys of the line are written
+   to one of num_partitions partition files, by key. Keys are a hash of
+   the line (exact duplicates) and, for near duplicates, the MinHash LSH
+   band hashes of its word trigrams. Lines are identified by their range
+   and their line number in the range;
+2. each partition is loaded on its own, and all the lines sharing a key
+   with a previous line are marked as duplicates;
+3. lines neither filtered nor marked as duplicates are written, in order.
+The first occurrence of duplicate lines is kept.
+
+Near-duplicate detection requires numpy, language confidence filtering
+requires pycld2.
+"""
+
+import os
+import zlib
+import array
+import shutil
+import hashlib
+import logging
+import tempfile
+import functools
+import multiprocessing
+
+from tqdm import tqdm
+
+import witokit.utils.files as futils
+import witokit.utils.compression as zutils
+import witokit.utils.metrics as mtutils
+import witokit.utils.scheduler as scutils
+
+from witokit.exceptions.parameter import InvalidParameterError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pycld2
+except ImportError:
+    pycld2 = None
+
+__all__ = ('DEDUP_MODES', 'check_near_dedup', 'get_input_size',
+           'get_num_partitions', 'get_line_ranges', 'iter_range_lines',
+           'index_range', 'find_duplicates', 'get_line_id', 'LineFilter',
+           'MinHasher', 'dedup')
+
+logger = logging.getLogger(__name__)
+
+DEDUP_MODES = ('none', 'exact', 'near')
+
+# Number of LSH bands and of MinHash values per band. Lines whose word
+# trigrams have a Jaccard similarity above ~(1 / NUM_BANDS) ** (1 /
+# BAND_SIZE), about 0.78, are likely to share a band
+NUM_BANDS = 12
+BAND_SIZE = 10
+SHINGLE_SIZE = 3
+MINHASH_SEED = 42
+
+# Line ids are range_num << LINE_ID_BITS | line number in range
+LINE_ID_BITS = 40
+
+# Estimated average size of a line, and memory used per indexed key
+AVG_LINE_SIZE = 100
+KEY_MEMORY = 48 if numpy is not None else 128
+
+KEY_TYPECODE = 'Q'
+BUFFER_SIZE = 64 * 1024
+
+# Share of the memory budget of a worker used to buffer partition keys
+BUFFER_MEMORY_SHARE = 0.5
+
+# Decompressed bytes read to estimate the compression ratio of a file
+SAMPLE_SIZE = 16 * 1024 * 1024
+
+
+def check_near_dedup():
+    """Raise an InvalidParameterError if numpy is not installed.
+
+    Near-duplicate detection requires numpy.
+    """
+    if numpy is None:
+        raise InvalidParameterError('Near-duplicate detection requires '
+                                    'numpy')
+
+
+def get_input_size(filepath):
+    """Return the size of filepath once decompressed.
+
+    The size of a compressed file is estimated from the compression ratio
+    of its first SAMPLE_SIZE decompressed bytes.
+    """
+    size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as input_stream:
+        compression = zutils.detect_compression(input_stream)
+        if not compression:
+            return size
+        sample_size = 0
+        with zutils.wrap_stream(input_stream, 'rb',
+                                compression) as sample_stream:
+            while sample_size < SAMPLE_SIZE:
+                data = sample_stream.read(BUFFER_SIZE)
+                if not data:
+                    return sample_size
+                sample_size += len(data)
+        return sample_size * size // max(input_stream.tell(), 1)
+
+
+def get_num_partitions(input_size, near, max_memory, num_workers):
+    """Return the number of partitions of the index of an input file.
+
+    Partitions are sized so that each fits in max_memory bytes, with at
+    least one partition per worker.
+    """
+    num_keys = input_size / AVG_LINE_SIZE * (1 + (NUM_BANDS if near else 0))
+    return max(num_workers, -(-int(num_keys * KEY_MEMORY) // max_memory))
+
+
+def get_line_ranges(filepath, num_ranges):
+    """Return [start, end) byte ranges of filepath made of whole lines."""
+    size = os.path.getsize(filepath)
+    boundaries = [0]
+    with open(filepath, 'rb') as input_stream:
+        for num in range(1, num_ranges):
+            offset = max(size * num // num_ranges, boundaries[-1])
+            input_stream.seek(offset)
+            if offset:
+                input_stream.readline()
+            boundaries.append(min(input_stream.tell(), size))
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:])
+            if end > start]
+
+
+def iter_range_lines(filepath, line_range):
+    """Yield the lines of the [start, end) byte range of filepath.
+
+    If line_range is None, yield all the lines of filepath, which may be
+    compressed.
+    """
+    if line_range is None:
+        with futils.open_stream(filepath, 'rb') as input_stream:
+            yield from input_stream
+        return
+    start, end = line_range
+    with open(filepath, 'rb') as input_stream:
+        input_stream.seek(start)
+        position = start
+        for line in input_stream:
+            if position >= end:
+                return
+            position += len(line)
+            yield line
+
+
+def get_line_id(range_num, line_num):
+    """Return the id of line line_num of range range_num."""
+    return range_num << LINE_ID_BITS | line_num
+
+
+class LineFilter():
+    """Filter of lines on their number of tokens and language confidence.
+
+    min_lang_confidence is the minimum percentage of the text of a line in
+    language lang (or in its most likely language if lang is None), as
+    detected by pycld2.
+    """
+
+    def __init__(self, min_tokens=None, max_tokens=None, lang=None,
+                 min_lang_confidence=None):
+        """Check filter parameters."""
+        if min_lang_confidence and pycld2 is None:
+            raise InvalidParameterError('Language confidence filtering '
+                                        'requires pycld2')
+        self._min_tokens = min_tokens
+        self._max_tokens = max_tokens
+        self._lang = lang
+        self._min_lang_confidence = min_lang_confidence
+
+    def _get_lang_confidence(self, text):
+        try:
+            _, _, details = pycld2.detect(text)
+        except pycld2.error:
+            return 0
+        for _, code, percent, _ in details:
+            if self._lang is None or code == self._lang:
+                return percent
+        return 0
+
+    def is_kept(self, line):
+        """Return whether line, a bytes line without line break, is kept."""
+        if self._min_tokens or self._max_tokens:
+            num_tokens = line.count(b' ') + 1 if line else 0
+            if self._min_tokens and num_tokens < self._min_tokens:
+                return False
+            if self._max_tokens and num_tokens > self._max_tokens:
+                return False
+        if self._min_lang_confidence:
+            return self._get_lang_confidence(line) \
+                >= self._min_lang_confidence
+        return True
+
+
+class MinHasher():
+    """MinHash LSH of the word trigrams of a line.
+
+    MinHash values use multiply-shift hashing of the CRC32 of each
+    shingle, with fixed random parameters, so that all workers compute the
+    same band hashes.
+    """
+
+    def __init__(self):
+        """Draw the parameters of the NUM_BANDS * BAND_SIZE hash functions."""
+        check_near_dedup()
+        rng = numpy.random.RandomState(MINHASH_SEED)
+        num_hashes = NUM_BANDS * BAND_SIZE
+        self._multipliers = rng.randint(
+            0, 2 ** 62, num_hashes, dtype=numpy.uint64) * 2 + 1
+        self._increments = rng.randint(0, 2 ** 62, num_hashes,
+                                       dtype=numpy.uint64)
+
+    def get_band_hashes(self, line):
+        """Return the list of the NUM_BANDS band hashes of a bytes line."""
+        tokens = line.split(b' ')
+        shingles = [b' '.join(tokens[index:index + SHINGLE_SIZE]) for index
+                    in range(max(len(tokens) - SHINGLE_SIZE + 1, 1))]
+        values = numpy.array([zlib.crc32(shingle) for shingle in shingles],
+                             dtype=numpy.uint64)
+        with numpy.errstate(over='ignore'):
+            signature = ((numpy.outer(self._multipliers, values)
+                          + self._increments[:, None]) >> 32).min(axis=1)
+        return [_hash(bytes([band]) + band_signature.tobytes())
+                for band, band_signature
+                in enumerate(signature.reshape(NUM_BANDS, BAND_SIZE))]
+
+
+def _hash(data):
+    """Return a 64-bit hash of bytes data."""
+    return int.from_bytes(hashlib.md5(data).digest()[:8], 'little')
+
+
+def _get_partition_filepath(tmp_dirpath, range_num, partition_num):
+    return os.path.join(tmp_dirpath, 'range{}-partition{}.keys'.format(
+        range_num, partition_num))
+
+
+class _PartitionWriter():
+    """Writer of the keys of the lines of a range to its partition files.
+
+    Keys are buffered in at most BUFFER_MEMORY_SHARE of max_memory bytes,
+    and flushed to the partition files opened one at a time. If near is
+    set, the MinHash LSH band hashes of lines are written as well.
+    """
+
+    def __init__(self, tmp_dirpath, range_num, num_partitions, max_memory,
+                 near=False):
+        """Allocate the buffers of the partitions."""
+        self._min_hasher = MinHasher() if near else None
+        self._tmp_dirpath = tmp_dirpath
+        self._range_num = range_num
+        self._partitions = [array.array(KEY_TYPECODE)
+                            for _ in range(num_partitions)]
+        self._max_buffered = max(min(
+            num_partitions * BUFFER_SIZE,
+            int(max_memory * BUFFER_MEMORY_SHARE)
+            // self._partitions[0].itemsize), 2)
+        self._num_buffered = 0
+
+    def add(self, line, line_num):
+        """Add the (key, line id) pairs of a line to their partitions."""
+        keys = [_hash(line)]
+        if self._min_hasher:
+            keys.extend(self._min_hasher.get_band_hashes(line))
+        line_id = get_line_id(self._range_num, line_num)
+        for key in keys:
+            partition = self._partitions[key % len(self._partitions)]
+            partition.append(key)
+            partition.append(line_id)
+        self._num_buffered += 2 * len(keys)
+        if self._num_buffered >= self._max_buffered:
+            self.flush()
+
+    def flush(self):
+        """Append the buffered pairs of each partition to its file."""
+        for partition_num, partition in enumerate(self._partitions):
+            if partition:
+                with open(_get_partition_filepath(
+                        self._tmp_dirpath, self._range_num, partition_num),
+                          'ab') as partition_stream:
+                    partition.tofile(partition_stream)
+                del partition[:]
+        self._num_buffered = 0
+
+
+def index_range(filepath, num_partitions, tmp_dirpath, line_filter,
+                dedup_mode, max_memory, indexed_range):
+    """Filter the lines of a byte range and index their keys.
+
+    indexed_range is a (range_num, line_range) tuple. Keys are written to
+    the partition files of range range_num under tmp_dirpath, as (key,
+    line id) pairs, buffered in a share of max_memory bytes. Return the
+    number of lines of the range and a bitmap of the lines filtered out.
+    """
+    range_num, line_range = indexed_range
+    writer = _PartitionWriter(tmp_dirpath, range_num, num_partitions,
+                              max_memory, dedup_mode == 'near')
+    filtered = bytearray()
+    num_lines = 0
+    for line_num, line in enumerate(iter_range_lines(filepath, line_range)):
+        num_lines += 1
+        if line_num % 8 == 0:
+            filtered.append(0)
+        line = line.rstrip(b'\n')
+        if not line_filter.is_kept(line):
+            filtered[line_num // 8] |= 1 << line_num % 8
+            continue
+        if dedup_mode != 'none':
+            writer.add(line, line_num)
+    writer.flush()
+    return num_lines, filtered
+
+
+def find_duplicates(tmp_dirpath, num_ranges, partition_num):
+    """Return the ids of the duplicate lines of a partition of the index.
+
+    A line is a duplicate if it shares a key with a previous line. The
+    partition files of partition_num, written for the ranges with keys in
+    the partition, are removed.
+    """
+    partition_filepaths = [_get_partition_filepath(
+        tmp_dirpath, range_num, partition_num)
+                           for range_num in range(num_ranges)]
+    pairs = array.array(KEY_TYPECODE)
+    for partition_filepath in partition_filepaths:
+        if not os.path.exists(partition_filepath):
+            continue
+        with open(partition_filepath, 'rb') as partition_stream:
+            pairs.frombytes(partition_stream.read())
+        os.remove(partition_filepath)
+    # Ranges are read in order, so lines are sorted by id
+    keys = pairs[::2]
+    line_ids = pairs[1::2]
+    del pairs
+    if numpy is not None:
+        keys = numpy.frombuffer(keys, dtype=numpy.uint64)
+        line_ids = numpy.frombuffer(line_ids, dtype=numpy.uint64)
+        _, first_indexes = numpy.unique(keys, return_index=True)
+        return array.array(KEY_TYPECODE,
+                           numpy.delete(line_ids, first_indexes).tobytes())
+    duplicates = array.array(KEY_TYPECODE)
+    seen_keys = set()
+    for key, line_id in zip(keys, line_ids):
+        if key in seen_keys:
+            duplicates.append(line_id)
+        else:
+            seen_keys.add(key)
+    return duplicates
+
+
+def _drop_lines(dropped, line_ids):
+    """Flag the lines of line_ids in the dropped bitmaps of their range."""
+    for line_id in line_ids:
+        range_num = line_id >> LINE_ID_BITS
+        line_num = line_id & ((1 << LINE_ID_BITS) - 1)
+        dropped[range_num][line_num // 8] |= 1 << line_num % 8
+
+
+def _get_dropped_lines(args, line_ranges, num_partitions, line_filter):
+    """Return the bitmaps of the lines to drop of each line range.
+
+    Lines are dropped if filtered out or marked as duplicates by the first
+    two passes, run by args.num_threads workers.
+    """
+    tmp_dirpath = tempfile.mkdtemp(
+        prefix='witokit-dedup-',
+        dir=os.path.dirname(os.path.abspath(args.input_filepath)))
+    try:
+        with multiprocessing.Pool(args.num_threads,
+                                  initializer=mtutils.init_worker,
+                                  initargs=(None, 'dedup')) as pool:
+            index = functools.partial(
+                mtutils.run_task, functools.partial(
+                    index_range, args.input_filepath, num_partitions,
+                    tmp_dirpath, line_filter, args.dedup,
+                    args.max_memory * 1024 * 1024))
+            with mtutils.timer('index'):
+                ranges = list(tqdm(mtutils.collect(pool.imap(
+                    index, enumerate(line_ranges))), total=len(line_ranges)))
+            mtutils.increment('lines_read', sum(num for num, _ in ranges))
+            dropped = [filtered for _, filtered in ranges]
+            find = functools.partial(
+                mtutils.run_task, functools.partial(
+                    find_duplicates, tmp_dirpath, len(line_ranges)))
+            with mtutils.timer('find_duplicates'):
+                for duplicates in tqdm(mtutils.collect(pool.imap_unordered(
+                        find, range(num_partitions))), total=num_partitions):
+                    _drop_lines(dropped, duplicates)
+    finally:
+        shutil.rmtree(tmp_dirpath)
+    return dropped
+
+
+def _iter_deduplicated_lines(input_filepath, line_ranges, dropped):
+    """Yield the lines of line_ranges not flagged in dropped bitmaps."""
+    for line_range, range_dropped in zip(line_ranges, dropped):
+        for line_num, line in enumerate(iter_range_lines(input_filepath,
+                                                         line_range)):
+            if range_dropped[line_num // 8] & 1 << line_num % 8:
+                mtutils.increment('lines_dropped')
+                continue
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            yield line
+
+
+def dedup(args):
+    """Filter and deduplicate the lines of a file, as per the dedup command.
+
+    args holds the arguments of the dedup command.
+    """
+    if args.min_lang_confidence is not None \
+            and not 0 < args.min_lang_confidence <= 100:
+        raise InvalidParameterError(
+            'Specified min-lang-confidence param should be in ]0, 100]')
+    if args.max_memory <= 0:
+        raise InvalidParameterError(
+            'Specified max-memory param should be positive')
+    line_filter = LineFilter(args.min_tokens, args.max_tokens, args.lang,
+                             args.min_lang_confidence)
+    if args.dedup == 'near':
+        check_near_dedup()
+    compression = zutils.get_compression(args.output_filepath, args.compress)
+    output_filepath = zutils.add_extension(args.output_filepath, compression)
+    # Compressed input files cannot be split into byte ranges
+    if zutils.get_compression(args.input_filepath):
+        line_ranges = [None]
+    else:
+        line_ranges = get_line_ranges(
+            args.input_filepath, args.num_threads * scutils.TASKS_PER_WORKER)
+    num_partitions = get_num_partitions(
+        get_input_size(args.input_filepath), args.dedup == 'near',
+        args.max_memory * 1024 * 1024, args.num_threads)
+    logger.info('Deduplicating input file {} with mode = {}, {} ranges and '
+                '{} partitions'.format(args.input_filepath, args.dedup,
+                                       len(line_ranges), num_partitions))
+    dropped = _get_dropped_lines(args, line_ranges, num_partitions,
+                                 line_filter)
+    with futils.open_stream(output_filepath, 'wb',
+                            compression) as output_stream, \
+            mtutils.timer('write'):
+        for line in _iter_deduplicated_lines(args.input_filepath, line_ranges,
+                                             dropped):
+            output_stream.write(line)
+            mtutils.increment('lines_written')
+    logger.info('Done deduplicating file to {}'.format(output_filepath))
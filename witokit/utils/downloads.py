@@ -0,0 +1,299 @@
+"""Download utils.
+
+Methods used to download Wikipedia archives over persistent connections,
+with HTTP Range resume, retries with exponential backoff and checksum
+verification.
+"""
+
+import os
+import time
+import socket
+import hashlib
+import logging
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+import concurrent.futures
+
+import witokit.utils.urls as uutils
+
+from witokit.exceptions.download import DownloadError
+
+__all__ = ('DownloadEngine', 'get_checksums', 'get_file_checksum',
+           'download_file')
+
+logger = logging.getLogger(__name__)
+
+CHECKSUM_ALGORITHMS = ('sha1', 'md5')
+READ_BUFFER_SIZE = 1024 * 1024
+TIMEOUT = 60
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# Errors worth retrying: network failures and server-side HTTP errors
+RETRYABLE_ERRORS = (urllib.error.URLError, ConnectionError, socket.timeout,
+                    http.client.HTTPException, DownloadError)
+
+
+def _is_retryable(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def get_checksums(wiki_dump_url, lang, date):
+    """Return the checksums published alongside a Wikipedia dump.
+
+    Return a (algorithm, {filename: checksum}) tuple read from the
+    *-sha1sums.txt file, or from the *-md5sums.txt file as a fallback.
+    Return (None, {}) if no checksum file could be retrieved.
+    """
+    for algorithm in CHECKSUM_ALGORITHMS:
+        url = uutils.get_wiki_checksums_url(wiki_dump_url, lang, date,
+                                            algorithm)
+        try:
+            with urllib.request.urlopen(url, timeout=TIMEOUT) as response:
+                lines = response.read().decode('utf-8').splitlines()
+        except urllib.error.URLError:
+            logger.debug('Could not retrieve checksums from {}'.format(url))
+            continue
+        checksums = {}
+        for line in lines:
+            if line.strip():
+                checksum, filename = line.split()
+                checksums[filename] = checksum
+        logger.info('Retrieved {} checksums from {}'.format(algorithm, url))
+        return algorithm, checksums
+    logger.warning('No checksums found for lang = \'{}\' and date = \'{}\'. '
+                   'Downloads will not be verified'.format(lang, date))
+    return None, {}
+
+
+def get_file_checksum(filepath, algorithm):
+    """Return the hexadecimal checksum of a file with a hashlib algorithm."""
+    file_hash = hashlib.new(algorithm)
+    with open(filepath, 'rb') as input_stream:
+        for data in iter(lambda: input_stream.read(READ_BUFFER_SIZE), b''):
+            file_hash.update(data)
+    return file_hash.hexdigest()
+
+
+def _is_valid(filepath, checksum, algorithm):
+    if not checksum:
+        return True
+    return get_file_checksum(filepath, algorithm) == checksum
+
+
+class DownloadEngine():
+    """Download files over a bounded number of persistent HTTP connections.
+
+    Downloads run in a pool of max_connections threads. Each thread keeps
+    one keep-alive connection per host, reused across files. Interrupted
+    downloads are resumed with HTTP Range requests and retried up to
+    max_retries times, waiting backoff ** attempt seconds in between. If
+    set, progress is called with the number of bytes of each data block
+    received. If the engine is exited on an exception, pending downloads
+    are cancelled and running ones interrupted.
+    """
+
+    def __init__(self, max_connections=3, max_retries=5, backoff=2,
+                 progress=None):
+        """Initialize the thread pool and download counters."""
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._progress = progress
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_connections)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._futures = []
+        self._cancelled = threading.Event()
+        self._start_time = time.monotonic()
+        self.bytes_downloaded = 0
+        self.files_downloaded = 0
+
+    def __enter__(self):
+        """Return the engine."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the engine, cancelling downloads on exceptions."""
+        self.close(cancel=exc_type is not None)
+
+    @property
+    def throughput(self):
+        """Return the aggregate download throughput in bytes per second."""
+        elapsed = time.monotonic() - self._start_time
+        return self.bytes_downloaded / elapsed if elapsed else 0
+
+    def close(self, cancel=False):
+        """Wait for pending downloads and close all connections.
+
+        If cancel is set, pending downloads are cancelled and running ones
+        interrupted instead. Interrupted downloads are resumed by the next
+        download of the same file.
+        """
+        if cancel:
+            self._cancelled.set()
+            for future in self._futures:
+                future.cancel()
+        self._executor.shutdown()
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+    def _get_connection(self, parsed_url):
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        connections = self._local.connections
+        key = (parsed_url.scheme, parsed_url.netloc)
+        if key not in connections:
+            if parsed_url.scheme == 'https':
+                connection = http.client.HTTPSConnection(parsed_url.netloc,
+                                                         timeout=TIMEOUT)
+            else:
+                connection = http.client.HTTPConnection(parsed_url.netloc,
+                                                        timeout=TIMEOUT)
+            connections[key] = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connections[key]
+
+    def _drop_connection(self, parsed_url):
+        connections = getattr(self._local, 'connections', {})
+        connection = connections.pop((parsed_url.scheme, parsed_url.netloc),
+                                     None)
+        if connection:
+            connection.close()
+
+    def _get_response(self, url, headers):
+        for _ in range(MAX_REDIRECTS):
+            parsed_url = urllib.parse.urlsplit(url)
+            path = parsed_url.path or '/'
+            if parsed_url.query:
+                path = '{}?{}'.format(path, parsed_url.query)
+            connection = self._get_connection(parsed_url)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except Exception:
+                self._drop_connection(parsed_url)
+                raise
+            if response.status not in REDIRECT_STATUSES:
+                return parsed_url, response
+            response.read()
+            url = urllib.parse.urljoin(url, response.getheader('Location'))
+        raise DownloadError('Too many redirects for {}'.format(url))
+
+    def _resume_download(self, url, part_filepath):
+        """Download url to part_filepath, resuming from its current size."""
+        offset = os.path.getsize(part_filepath) \
+            if os.path.exists(part_filepath) else 0
+        headers = {}
+        if offset:
+            logger.debug('Resuming download of {} from byte {}'
+                         .format(url, offset))
+            headers['Range'] = 'bytes={}-'.format(offset)
+        parsed_url, response = self._get_response(url, headers)
+        if response.status == 416 and offset:
+            # Nothing left to download: part file is already complete
+            response.read()
+            return
+        if response.status >= 400:
+            response.read()
+            raise urllib.error.HTTPError(url, response.status, response.reason,
+                                         response.headers, None)
+        if response.status != 206:
+            offset = 0
+        expected_size = response.getheader('Content-Length')
+        received_size = 0
+        buffer = bytearray(READ_BUFFER_SIZE)
+        try:
+            with open(part_filepath, 'ab' if offset else 'wb') \
+                    as output_stream:
+                for size in iter(lambda: response.readinto(buffer), 0):
+                    if self._cancelled.is_set():
+                        raise DownloadError('Download of {} cancelled'
+                                            .format(url))
+                    output_stream.write(memoryview(buffer)[:size])
+                    received_size += size
+                    with self._lock:
+                        self.bytes_downloaded += size
+                    if self._progress:
+                        self._progress(size)
+        except Exception:
+            self._drop_connection(parsed_url)
+            raise
+        if expected_size is not None and received_size < int(expected_size):
+            self._drop_connection(parsed_url)
+            raise DownloadError('Connection closed after {} of {} bytes from '
+                                '{}'.format(received_size, expected_size, url))
+
+    def download(self, url, output_filepath, checksum=None, algorithm=None):
+        """Download url to output_filepath in the calling thread.
+
+        Skip the download if output_filepath already exists and matches
+        checksum. Data is first downloaded to a .part file which is resumed
+        after a failure. The downloaded file is verified against checksum
+        (computed with the hashlib algorithm) before being moved to
+        output_filepath.
+        """
+        if os.path.exists(output_filepath) \
+                and _is_valid(output_filepath, checksum, algorithm):
+            logger.info('Skipping {}: file already downloaded'.format(url))
+            return output_filepath
+        part_filepath = '{}.part'.format(output_filepath)
+        for attempt in range(self._max_retries + 1):
+            try:
+                self._resume_download(url, part_filepath)
+                if not _is_valid(part_filepath, checksum, algorithm):
+                    os.remove(part_filepath)
+                    raise DownloadError('Checksum mismatch for {}'
+                                        .format(url))
+                os.replace(part_filepath, output_filepath)
+                with self._lock:
+                    self.files_downloaded += 1
+                return output_filepath
+            except Exception as error:  # pylint:disable=W0703
+                if self._cancelled.is_set():
+                    raise error
+                if not _is_retryable(error) or attempt == self._max_retries:
+                    logger.error('Could not download archive from {}'
+                                 .format(url))
+                    raise error
+                delay = self._backoff ** attempt
+                logger.warning('Download of {} failed: {}. Retrying in {}s'
+                               .format(url, error, delay))
+                time.sleep(delay)
+        return output_filepath
+
+    def download_all(self, downloads, on_error=None):
+        """Download files concurrently.
+
+        downloads is an iterable of (url, output_filepath, checksum,
+        algorithm) tuples. Yield output filepaths as downloads complete.
+        If set, on_error is called with the download tuple and the error of
+        each failed download, which is then skipped instead of raised.
+        """
+        futures = {self._executor.submit(self.download, *download): download
+                   for download in downloads}
+        self._futures.extend(futures)
+        for future in concurrent.futures.as_completed(futures):
+            if on_error and future.exception():
+                on_error(futures[future], future.exception())
+                continue
+            yield future.result()
+
+
+def download_file(url, output_filepath, checksum=None, algorithm=None,
+                  max_retries=5, backoff=2):
+    """Download url to output_filepath over a single connection.
+
+    See DownloadEngine.download for details.
+    """
+    with DownloadEngine(1, max_retries, backoff) as engine:
+        return engine.download(url, output_filepath, checksum, algorithm)
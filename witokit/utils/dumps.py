@@ -0,0 +1,232 @@
+"""Dump utils.
+
+Methods used to discover the archives of a Wikipedia dump, along with
+their size and checksum.
+
+Archives are read from the machine-readable dumpstatus.json file of the
+dump when it exists, and from the HTML listing of the dump otherwise.
+Resolved archives are cached on disk, keyed by lang and date, so that
+repeated runs do not query the dump site again. Cached 'latest' dumps
+expire after LATEST_MAX_AGE seconds.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import posixpath
+import collections
+import urllib.error
+import urllib.request
+
+from bs4 import BeautifulSoup
+
+import witokit.utils.downloads as dutils
+import witokit.utils.files as futils
+import witokit.utils.urls as uutils
+
+__all__ = ('DumpFile', 'get_cache_dirpath', 'get_dump_files',
+           'resolve_date', 'get_downloads', 'log_download_plan')
+
+logger = logging.getLogger(__name__)
+
+LATEST_MAX_AGE = 24 * 3600
+TIMEOUT = 60
+
+# Preferred checksum algorithm of the files listed in dumpstatus.json
+DUMP_STATUS_ALGORITHMS = ('sha1', 'md5')
+
+# size is None when the size of an archive is unknown
+DumpFile = collections.namedtuple('DumpFile', ['href', 'size', 'algorithm',
+                                               'checksum'])
+
+
+def get_cache_dirpath():
+    """Return the default directory of the dump cache.
+
+    Follow the XDG base directory specification.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'witokit', 'dumps')
+
+
+def _get_cache_filepath(cache_dirpath, lang, date):
+    return os.path.join(cache_dirpath, '{}wiki-{}.json'.format(lang, date))
+
+
+def _load_cache(cache_filepath, date):
+    """Return the cached archives of a dump, or an empty dict."""
+    if not os.path.exists(cache_filepath):
+        return {}
+    try:
+        with open(cache_filepath, 'r', encoding='utf-8') as cache_stream:
+            cache = json.load(cache_stream)
+    except ValueError:
+        logger.warning('Ignoring corrupted dump cache {}'
+                       .format(cache_filepath))
+        return {}
+    if date == 'latest' and time.time() - cache['time'] > LATEST_MAX_AGE:
+        return {}
+    return cache
+
+
+def _save_cache(cache_filepath, cache):
+    os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+    tmp_filepath = '{}.tmp'.format(cache_filepath)
+    with open(tmp_filepath, 'w', encoding='utf-8') as cache_stream:
+        json.dump(cache, cache_stream, indent=2, sort_keys=True)
+    os.replace(tmp_filepath, cache_filepath)
+
+
+def _select(items, matcher, key=lambda item: item):
+    """Return the items whose key matches matcher.
+
+    Return the numbered archives if any, the single archives otherwise.
+    """
+    selected = {'multi': [], 'single': []}
+    for item in items:
+        match = matcher.match(key(item))
+        if match:
+            selected['multi' if match.group('multi') else 'single'].append(
+                item)
+    return selected['multi'] or selected['single']
+
+
+def _get_dated_filename_pattern(lang):
+    """Return a compiled regex matching the dated filenames of a wiki."""
+    return re.compile(r'{}wiki-(\d{{8}})-'.format(re.escape(lang)))
+
+
+def _get_dump_status_files(wiki_dump_url, matcher):
+    """Return the archives listed in the dumpstatus.json file of a dump.
+
+    Return an empty list if the file cannot be retrieved.
+    """
+    url = uutils.get_wiki_dump_status_url(wiki_dump_url)
+    try:
+        with urllib.request.urlopen(url, timeout=TIMEOUT) as response:
+            dump_status = json.loads(response.read().decode('utf-8'))
+    except (urllib.error.URLError, ValueError):
+        logger.debug('Could not retrieve dump status from {}'.format(url))
+        return []
+    files = [(filename, info) for job in dump_status.get('jobs', {}).values()
+             for filename, info in job.get('files', {}).items()]
+    dump_files = []
+    for filename, info in _select(files, matcher, key=lambda x: x[0]):
+        algorithm = next((algorithm for algorithm in DUMP_STATUS_ALGORITHMS
+                          if info.get(algorithm)), None)
+        dump_files.append(DumpFile(filename, info.get('size'), algorithm,
+                                   info.get(algorithm)))
+    return dump_files
+
+
+def _get_html_files(wiki_dump_url, lang, date, matcher):
+    """Return the archives linked from the HTML listing of a dump."""
+    try:
+        with urllib.request.urlopen(wiki_dump_url, timeout=TIMEOUT) \
+                as response:
+            html_doc = response.read()
+    except urllib.error.HTTPError as error:
+        logger.error('HTTPError using lang = \'{}\' and date = \'{}\'. '
+                     'Could not retrieve any Wikipedia data at URL = {}'
+                     .format(lang, date, wiki_dump_url))
+        raise error
+    soup = BeautifulSoup(html_doc, 'html.parser')
+    hrefs = set(posixpath.basename(link['href'])
+                for link in soup.find_all('a', href=True))
+    algorithm, checksums = dutils.get_checksums(wiki_dump_url, lang, date)
+    if date == 'latest':
+        # Checksum files of 'latest' dumps list the dated filenames
+        filename_pattern = _get_dated_filename_pattern(lang)
+        checksums = {filename_pattern.sub('{}wiki-latest-'.format(lang),
+                                          filename, count=1): checksum
+                     for filename, checksum in checksums.items()}
+    return [DumpFile(href, None, algorithm, checksums.get(href))
+            for href in sorted(_select(hrefs, matcher))]
+
+
+def get_dump_files(wiki_dump_url, lang, date, multistream=False,
+                   cache_dirpath=None):
+    """Return the list of DumpFiles of the archives of a dump.
+
+    If multistream is set, return the multistream archives and their
+    indexes. The archives of complete dumps (whose checksums are all
+    known) are cached under cache_dirpath, if set.
+    """
+    kind = 'multistream' if multistream else 'articles'
+    cache_filepath = _get_cache_filepath(cache_dirpath, lang, date) \
+        if cache_dirpath else None
+    cache = _load_cache(cache_filepath, date) if cache_filepath else {}
+    if cache.get(kind):
+        logger.info('Using cached archive list of {}wiki-{} from {}'
+                    .format(lang, date, cache_filepath))
+        return [DumpFile(**dump_file) for dump_file in cache[kind]]
+    logger.info('Collecting arxiv from {}'.format(wiki_dump_url))
+    matcher = uutils.get_wikipedia_arxiv_matcher(lang, date, multistream)
+    dump_files = _get_dump_status_files(wiki_dump_url, matcher)
+    if not dump_files:
+        dump_files = _get_html_files(wiki_dump_url, lang, date, matcher)
+    if not dump_files:
+        logger.warning('No wikipedia arxiv found')
+    elif cache_filepath and all(dump_file.checksum
+                                for dump_file in dump_files):
+        cache[kind] = [dump_file._asdict() for dump_file in dump_files]
+        cache['time'] = time.time()
+        _save_cache(cache_filepath, cache)
+    return dump_files
+
+
+def resolve_date(wiki_dump_url, lang, date, cache_dirpath=None):
+    """Return the yyyymmdd date of a dump.
+
+    The date of a 'latest' dump is read from the filenames of its
+    checksum file, and cached under cache_dirpath, if set. Return
+    'latest' if the date cannot be resolved.
+    """
+    if date != 'latest':
+        return date
+    cache_filepath = _get_cache_filepath(cache_dirpath, lang, date) \
+        if cache_dirpath else None
+    cache = _load_cache(cache_filepath, date) if cache_filepath else {}
+    if cache.get('date'):
+        return cache['date']
+    filename_pattern = _get_dated_filename_pattern(lang)
+    _, checksums = dutils.get_checksums(wiki_dump_url, lang, date)
+    dates = set(match.group(1) for match in map(filename_pattern.match,
+                                                checksums) if match)
+    if len(dates) != 1:
+        logger.warning('Could not resolve the date of {}wiki-latest'
+                       .format(lang))
+        return date
+    cache['date'] = dates.pop()
+    if cache_filepath:
+        cache.setdefault('time', time.time())
+        _save_cache(cache_filepath, cache)
+    logger.info('Resolved {lang}wiki-latest to {lang}wiki-{date}'
+                .format(lang=lang, date=cache['date']))
+    return cache['date']
+
+
+def get_downloads(dump_files, wiki_dump_url, output_dirpath):
+    """Return the downloads of dump_files, to be passed to DownloadEngine.
+
+    Archives of known size are downloaded largest first, so that no
+    connection ends up alone with the largest archive.
+    """
+    return [(uutils.get_wiki_arxiv_url(wiki_dump_url, dump_file.href),
+             futils.get_download_output_filepath(output_dirpath,
+                                                 dump_file.href),
+             dump_file.checksum, dump_file.algorithm)
+            for dump_file in sorted(dump_files, reverse=True,
+                                    key=lambda x: x.size or 0)]
+
+
+def log_download_plan(dump_files, wiki_dump_url):
+    """Log the number and total size of dump_files, if known."""
+    if all(dump_file.size is not None for dump_file in dump_files):
+        logger.info('Planning to download {} archives ({:.1f} MB) from {}'
+                    .format(len(dump_files), sum(
+                        dump_file.size for dump_file in dump_files) / 1e6,
+                            wiki_dump_url))
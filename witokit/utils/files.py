@@ -1,17 +1,32 @@
 """Files utils."""
 
+import io
 import os
+import re
+import sys
+import contextlib
 import natsort
 
+import witokit.utils.compression as zutils
+
 __all__ = ('get_input_filepaths', 'get_output_filepath',
            'get_tmp_filepaths', 'get_tmp_dirpath',
-           'get_download_output_filepath', 'get_bz2_arxivs')
+           'get_download_output_filepath', 'get_bz2_arxivs',
+           'get_shard_filepath', 'natsorted', 'get_wiki_lang',
+           'open_stream', 'get_manifest_filepath')
+
+# Size of the buffer used to copy files into one another
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
 
 
 def get_bz2_arxivs(dirpath):
-    """Return a list of absolute .bz2 filepaths from a given dirpath."""
+    """Return a list of absolute .bz2 filepaths from a given dirpath.
+
+    Multistream indexes and partial downloads (.bz2.part) are excluded.
+    """
     return [os.path.join(dirpath, filename) for filename in
-            os.listdir(dirpath) if '.bz2' in filename]
+            os.listdir(dirpath) if filename.endswith('.bz2')
+            and 'multistream-index' not in filename]
 
 
 def get_download_output_filepath(output_dirpath, href):
@@ -25,12 +40,16 @@ def get_tmp_dirpath(input_xml_filepath):
     return os.path.join(os.path.dirname(input_xml_filepath), 'tmp')
 
 
+def natsorted(items, key=None):
+    """Return items sorted in natural, case-insensitive order."""
+    return natsort.natsorted(items, key=key, alg=natsort.ns.IGNORECASE)
+
+
 def get_tmp_filepaths(xml_input_dirpath):
     """Return all .txt files under the output_txt_dirpath/tmp/ dir."""
     tmp_dirpath = get_tmp_dirpath(xml_input_dirpath)
-    return natsort.natsorted([os.path.join(tmp_dirpath, filename) for filename
-                              in os.listdir(tmp_dirpath)],
-                             alg=natsort.ns.IGNORECASE)
+    return natsorted([os.path.join(tmp_dirpath, filename) for filename
+                      in os.listdir(tmp_dirpath)])
 
 
 def get_output_filepath(input_xml_filepath, output_txt_filepath):
@@ -46,6 +65,24 @@ def get_output_filepath(input_xml_filepath, output_txt_filepath):
     return output_txt_filepath
 
 
+def get_shard_filepath(output_dirpath, shard_num):
+    """Return filepath to output_dirpath/shard-xxxxx.txt.
+
+    Create output_dirpath if not exists.
+    """
+    os.makedirs(output_dirpath, exist_ok=True)
+    return os.path.join(output_dirpath, 'shard-{:05d}.txt'.format(shard_num))
+
+
+def get_manifest_filepath(dirpath):
+    """Return filepath to the dirpath/manifest.json file.
+
+    Create dirpath if not exists.
+    """
+    os.makedirs(dirpath, exist_ok=True)
+    return os.path.join(dirpath, 'manifest.json')
+
+
 def get_input_filepaths(dirpath):
     """Return a list of absolute XML filepaths from a given dirpath.
 
@@ -54,3 +91,49 @@ def get_input_filepaths(dirpath):
     return [os.path.join(dirpath, filename) for filename in
             os.listdir(dirpath) if '.xml' in filename
             and '.bz2' not in filename]
+
+
+def get_wiki_lang(filepath):
+    """Return the language code of a Wikipedia archive from its filename.
+
+    Return None if filepath does not follow the langwiki-date-* pattern.
+    """
+    match = re.match(r'(.+?)wiki-', os.path.basename(filepath))
+    if not match:
+        return None
+    return match.group(1)
+
+
+@contextlib.contextmanager
+def open_stream(filepath, mode='rb', compression=None):
+    """Open filepath, (de)compressing its content with compression.
+
+    If filepath is '-', yield the binary buffer of stdin (read mode) or of
+    stdout (write mode), which is left open. In read mode, the compression
+    is detected from the content of the stream. Text modes use UTF-8.
+    """
+    try:
+        with contextlib.ExitStack() as stack:
+            if filepath == '-':
+                stream = sys.stdin.buffer if 'r' in mode \
+                    else sys.stdout.buffer
+            else:
+                stream = stack.enter_context(open(
+                    filepath, mode.replace('t', '').replace('b', '') + 'b'))
+            if 'r' in mode:
+                compression = zutils.detect_compression(stream)
+            if compression:
+                stream = stack.enter_context(
+                    zutils.wrap_stream(stream, mode, compression))
+            if 'b' in mode:
+                yield stream
+            else:
+                # The wrapper is detached so as not to close the stream
+                text_stream = io.TextIOWrapper(stream, encoding='utf-8')
+                try:
+                    yield text_stream
+                finally:
+                    text_stream.detach()
+    finally:
+        if filepath == '-' and 'r' not in mode:
+            sys.stdout.buffer.flush()
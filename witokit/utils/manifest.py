@@ -0,0 +1,129 @@
+"""Manifest utils.
+
+Methods used to record which outputs were generated from which inputs
+and with which settings, so that extract and process can skip up-to-date
+outputs and resume interrupted runs.
+
+A manifest is a JSON file mapping each output filepath to an entry
+recording the fingerprints of its inputs (path, size and mtime, or content
+hash), the settings used to generate it and its size.
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+from witokit.utils.streams import ArxivChunk
+
+__all__ = ('load', 'save', 'get_fingerprint', 'add_entry',
+           'is_up_to_date')
+
+logger = logging.getLogger(__name__)
+
+HASH_ALGORITHM = 'sha1'
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Content hashes of the byte ranges of input files, keyed by path, size,
+# mtime and ranges, so that each range is read once per run
+_checksums = {}
+
+
+def load(manifest_filepath):
+    """Return the entries of a manifest, or an empty dict if none."""
+    if not os.path.exists(manifest_filepath):
+        return {}
+    with open(manifest_filepath, 'r', encoding='utf-8') as manifest_stream:
+        try:
+            return json.load(manifest_stream)
+        except ValueError:
+            logger.warning('Ignoring corrupted manifest {}'
+                           .format(manifest_filepath))
+            return {}
+
+
+def save(manifest_filepath, entries):
+    """Atomically save manifest entries to manifest_filepath."""
+    tmp_manifest_filepath = '{}.tmp'.format(manifest_filepath)
+    with open(tmp_manifest_filepath, 'w', encoding='utf-8') \
+            as manifest_stream:
+        json.dump(entries, manifest_stream, indent=2, sort_keys=True)
+    os.replace(tmp_manifest_filepath, manifest_filepath)
+
+
+def _get_checksum(filepath, ranges):
+    """Return the hash of the content of [start, end) ranges of filepath.
+
+    end is None for the end of the file. Hashes are cached until the size
+    or mtime of filepath change.
+    """
+    stat = os.stat(filepath)
+    key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns,
+           tuple(ranges))
+    if key not in _checksums:
+        content_hash = hashlib.new(HASH_ALGORITHM)
+        with open(filepath, 'rb') as input_stream:
+            for start, end in ranges:
+                input_stream.seek(start)
+                remaining = (stat.st_size if end is None else end) - start
+                while remaining > 0:
+                    data = input_stream.read(min(READ_BUFFER_SIZE, remaining))
+                    if not data:
+                        break
+                    content_hash.update(data)
+                    remaining -= len(data)
+        _checksums[key] = content_hash.hexdigest()
+    return _checksums[key]
+
+
+def get_fingerprint(source, use_hash=False):
+    """Return the fingerprint of an XML filepath or ArxivChunk source.
+
+    The fingerprint holds the path, size and mtime of the input file, or
+    the hash of its content if use_hash is set, plus the byte range of
+    ArxivChunks. The hash of an ArxivChunk only covers its byte range and
+    the header stream of its archive.
+    """
+    if isinstance(source, ArxivChunk):
+        fingerprint = {'start': source.start, 'end': source.end}
+        filepath = source.arxiv
+        ranges = [(source.start, source.end)]
+        if source.start and source.header_end:
+            ranges.insert(0, (0, source.header_end))
+    else:
+        fingerprint = {}
+        filepath = source
+        ranges = [(0, None)]
+    fingerprint['path'] = os.path.abspath(filepath)
+    if use_hash:
+        fingerprint[HASH_ALGORITHM] = _get_checksum(filepath, ranges)
+    else:
+        stat = os.stat(filepath)
+        fingerprint['size'] = stat.st_size
+        fingerprint['mtime'] = stat.st_mtime_ns
+    return fingerprint
+
+
+def add_entry(entries, output_filepath, sources, settings, use_hash=False):
+    """Record in entries that output_filepath was generated from sources."""
+    entries[os.path.abspath(output_filepath)] = {
+        'inputs': [get_fingerprint(source, use_hash) for source in sources],
+        'settings': settings,
+        'size': os.path.getsize(output_filepath)}
+
+
+def is_up_to_date(entries, output_filepath, sources, settings,
+                  use_hash=False):
+    """Return True if output_filepath is up to date in manifest entries.
+
+    That is, if output_filepath exists with its recorded size and was
+    generated from the same sources, unchanged, with the same settings.
+    """
+    entry = entries.get(os.path.abspath(output_filepath))
+    if not entry or not os.path.exists(output_filepath):
+        return False
+    if entry['settings'] != settings \
+            or entry['size'] != os.path.getsize(output_filepath):
+        return False
+    return entry['inputs'] == [get_fingerprint(source, use_hash)
+                               for source in sources]
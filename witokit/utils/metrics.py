@@ -0,0 +1,348 @@
+"""Metrics utils.
+
+Per-process counters and timers of the pipeline stages (bytes downloaded
+and decompressed, articles extracted, sentences and tokens emitted, time
+spent in wikiextractor and in the tokenizer, worker idle time, etc.).
+
+Pool workers run their tasks through run_task, which returns the metrics
+recorded during the task along with its result. The parent process
+aggregates them with collect, so that its own metrics cover all workers.
+Workers can also be given a memory budget, checked with check_rss: the
+metrics of a task then report whether its worker exceeded its budget, and
+a WorkerPool replaces that worker with a new one.
+"""
+
+import os
+import gc
+import time
+import json
+import logging
+import cProfile
+import resource
+import queue
+import itertools
+import functools
+import threading
+import multiprocessing
+import contextlib
+import collections
+
+__all__ = ('METRICS_FORMATS', 'increment', 'timer', 'timed', 'reset',
+           'snapshot', 'merge', 'init_worker', 'run_task', 'collect',
+           'WorkerPool', 'get_rss', 'get_peak_rss', 'check_rss',
+           'to_prometheus', 'save')
+
+logger = logging.getLogger(__name__)
+
+METRICS_FORMATS = ('json', 'prometheus')
+
+_counters = collections.Counter()
+_timers = collections.Counter()
+_lock = threading.Lock()
+
+# State of the current pool worker: end time of its last task, profiler
+# and memory budget
+_worker = {'last_task_end': None, 'profiler': None, 'profile_filepath': None,
+           'max_rss': None, 'rss_exceeded': False}
+
+
+def increment(name, value=1):
+    """Add value to counter name."""
+    with _lock:
+        _counters[name] += value
+
+
+def _add_time(name, seconds):
+    with _lock:
+        _timers[name] += seconds
+
+
+@contextlib.contextmanager
+def timer(name):
+    """Add the time spent in the with block to timer name."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_time(name, time.perf_counter() - start_time)
+
+
+def timed(name, iterable):
+    """Yield the items of iterable, adding the time to get them to name."""
+    iterator = iter(iterable)
+    while True:
+        start_time = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            _add_time(name, time.perf_counter() - start_time)
+            return
+        _add_time(name, time.perf_counter() - start_time)
+        yield item
+
+
+def reset():
+    """Reset all counters and timers."""
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+
+def snapshot():
+    """Return a copy of all counters and timers."""
+    with _lock:
+        return {'counters': dict(_counters), 'timers': dict(_timers)}
+
+
+def merge(metrics):
+    """Add the counters and timers of a snapshot to the current ones."""
+    with _lock:
+        _counters.update(metrics['counters'])
+        _timers.update(metrics['timers'])
+
+
+def init_worker(profile_dirpath=None, profile_prefix='worker',
+                max_rss=None):
+    """Initialize the metrics of a pool worker.
+
+    Metrics inherited from the parent process are reset. If
+    profile_dirpath is set, tasks are profiled with cProfile and the stats
+    of the worker are saved to profile_dirpath/profile_prefix-pid.prof.
+    max_rss is the memory budget of the worker in bytes, if any.
+    """
+    global _lock  # pylint:disable=W0603
+    # Workers replaced during a run are forked from a parent whose threads
+    # may hold the lock at that time
+    _lock = threading.Lock()
+    reset()
+    _worker['last_task_end'] = time.perf_counter()
+    _worker['max_rss'] = max_rss
+    if profile_dirpath:
+        os.makedirs(profile_dirpath, exist_ok=True)
+        _worker['profiler'] = cProfile.Profile()
+        _worker['profile_filepath'] = os.path.join(
+            profile_dirpath, '{}-{}.prof'.format(profile_prefix, os.getpid()))
+
+
+def run_task(func, *args):
+    """Run func(*args) in a pool worker.
+
+    Return the result of func and the metrics recorded while running it,
+    including the worker idle time since its previous task.
+    """
+    if _worker['last_task_end'] is not None:
+        _add_time('worker_idle',
+                  time.perf_counter() - _worker['last_task_end'])
+    _worker['rss_exceeded'] = False
+    profiler = _worker['profiler']
+    if profiler:
+        profiler.enable()
+    try:
+        result = func(*args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(_worker['profile_filepath'])
+    check_rss()
+    metrics = snapshot()
+    reset()
+    _worker['last_task_end'] = time.perf_counter()
+    return result, metrics
+
+
+def collect(results):
+    """Merge the metrics of (result, metrics) tuples and yield results."""
+    for result, metrics in results:
+        merge(metrics)
+        yield result
+
+
+def _get_result(results):
+    result = results.get()
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+class WorkerPool():
+    """Pool of workers running tasks through run_task.
+
+    Each worker is a single process multiprocessing pool, so that a worker
+    whose task reports that it exceeded its memory budget can be replaced
+    alone: its pool is closed, the worker exits once done with the tasks
+    already handed to it, and a new worker takes its place. Tasks go to the
+    worker with the fewest pending tasks. Workers are started with context
+    and initialized with init_worker(*initargs). Results are (result,
+    metrics) tuples, to be passed to collect.
+    """
+
+    def __init__(self, processes, initargs=(), context=multiprocessing):
+        """Start processes workers."""
+        self._initargs = initargs
+        self._context = context
+        self._lock = threading.Lock()
+        self._num_pending = {}
+        self._exceeded = set()
+        self._retired = []
+        self._workers = [self._start_worker() for _ in range(processes)]
+
+    def __enter__(self):
+        """Return the pool."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Terminate the pool."""
+        self.terminate()
+
+    def terminate(self):
+        """Stop all workers immediately."""
+        for worker in self._workers + self._retired:
+            worker.terminate()
+
+    def _start_worker(self):
+        worker = self._context.Pool(1, initializer=init_worker,
+                                    initargs=self._initargs)
+        with self._lock:
+            self._num_pending[worker] = 0
+        return worker
+
+    def _on_result(self, worker, callback, result):
+        with self._lock:
+            self._num_pending[worker] -= 1
+            if result[1]['counters'].get('rss_budget_exceeded'):
+                self._exceeded.add(worker)
+        if callback:
+            callback(result)
+
+    def _on_error(self, worker, error_callback, error):
+        with self._lock:
+            self._num_pending[worker] -= 1
+        if error_callback:
+            error_callback(error)
+
+    def _replace_workers(self):
+        """Replace the workers which exceeded their memory budget."""
+        with self._lock:
+            exceeded, self._exceeded = self._exceeded, set()
+            done = [worker for worker in self._retired
+                    if not self._num_pending[worker]]
+        for worker in done:
+            worker.join()
+            self._retired.remove(worker)
+            with self._lock:
+                del self._num_pending[worker]
+        for num, worker in enumerate(self._workers):
+            if worker in exceeded:
+                logger.info('Replacing worker {} after its pending tasks'
+                            .format(num))
+                worker.close()
+                self._retired.append(worker)
+                self._workers[num] = self._start_worker()
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        """Run func(*args) in a worker and return its AsyncResult.
+
+        callback and error_callback are called as with
+        multiprocessing.pool.Pool.apply_async.
+        """
+        self._replace_workers()
+        with self._lock:
+            worker = min(self._workers, key=self._num_pending.get)
+            self._num_pending[worker] += 1
+        return worker.apply_async(
+            run_task, (func,) + tuple(args),
+            callback=functools.partial(self._on_result, worker, callback),
+            error_callback=functools.partial(self._on_error, worker,
+                                             error_callback))
+
+    def imap_unordered(self, func, tasks):
+        """Yield the results of func(task) for tasks, as soon as done.
+
+        Each worker is handed one task at a time, and its next task as soon
+        as it is done, so that tasks are taken in order by the first free
+        worker.
+        """
+        tasks = iter(tasks)
+        results = queue.Queue()
+        num_pending = 0
+        for task in itertools.islice(tasks, len(self._workers)):
+            self.apply_async(func, (task,), results.put, results.put)
+            num_pending += 1
+        while num_pending:
+            result = _get_result(results)
+            num_pending -= 1
+            for task in itertools.islice(tasks, 1):
+                self.apply_async(func, (task,), results.put, results.put)
+                num_pending += 1
+            yield result
+
+
+def get_peak_rss(children=False):
+    """Return the peak resident set size of this process in bytes.
+
+    If children is set, return the maximum of the peak RSS of this process
+    and of its largest terminated child.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        peak_rss = max(peak_rss, resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    if os.uname().sysname == 'Darwin':
+        return peak_rss
+    return peak_rss * 1024
+
+
+def get_rss():
+    """Return the current resident set size of this process in bytes.
+
+    Fall back to the peak RSS where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm_stream:
+            return int(statm_stream.read().split()[1]) \
+                * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return get_peak_rss()
+
+
+def check_rss():
+    """Check the RSS of the current worker against its memory budget.
+
+    The first time the budget is exceeded during a task, garbage is
+    collected, a warning is logged and the rss_budget_exceeded counter of
+    the task is incremented, so that a WorkerPool replaces the worker.
+    """
+    if not _worker['max_rss'] or _worker['rss_exceeded']:
+        return
+    rss = get_rss()
+    if rss > _worker['max_rss']:
+        _worker['rss_exceeded'] = True
+        increment('rss_budget_exceeded')
+        gc.collect()
+        logger.warning('Worker {} exceeded its memory budget: RSS of {:.0f} '
+                       'MB > {:.0f} MB'.format(os.getpid(), rss / 1e6,
+                                               _worker['max_rss'] / 1e6))
+
+
+def to_prometheus(metrics):
+    """Return metrics in the Prometheus text exposition format."""
+    lines = []
+    for name, value in sorted(metrics['counters'].items()):
+        lines.append('# TYPE witokit_{}_total counter'.format(name))
+        lines.append('witokit_{}_total {}'.format(name, value))
+    for name, value in sorted(metrics['timers'].items()):
+        lines.append('# TYPE witokit_{}_seconds_total counter'.format(name))
+        lines.append('witokit_{}_seconds_total {:.6f}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def save(metrics_filepath, metrics_format='json'):
+    """Save all counters and timers to metrics_filepath."""
+    metrics = snapshot()
+    with open(metrics_filepath, 'w', encoding='utf-8') as metrics_stream:
+        if metrics_format == 'prometheus':
+            metrics_stream.write(to_prometheus(metrics))
+        else:
+            json.dump(metrics, metrics_stream, indent=2, sort_keys=True)
+            metrics_stream.write('\n')
@@ -0,0 +1,301 @@
+"""Sampling utils.
+
+Methods used to sample lines of a (potentially huge) .txt file in a single
+pass, and to build a line-offset index so that repeated samples of the
+same file can seek to the sampled lines instead of rescanning it.
+"""
+
+import os
+import math
+import array
+import random
+import logging
+import fractions
+import itertools
+
+import witokit.utils.files as futils
+import witokit.utils.compression as zutils
+
+from witokit.exceptions.parameter import InvalidParameterError
+
+__all__ = ('sample_top', 'sample_balanced', 'sample_bernoulli',
+           'sample_reservoir', 'get_index_filepath', 'build_line_index',
+           'load_line_index', 'get_indexed_line_nums', 'read_lines_at',
+           'count_lines', 'sample')
+
+logger = logging.getLogger(__name__)
+
+READ_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+def sample_top(lines, num_lines):
+    """Yield the first num_lines lines."""
+    return itertools.islice(lines, num_lines)
+
+
+def _get_balanced_picker(ratio):
+    """Return a function telling whether a line number is to be sampled.
+
+    The ratio is converted to an exact fraction num/den so that exactly
+    floor(total * num / den) lines are picked, evenly spread.
+    """
+    ratio = fractions.Fraction(ratio).limit_denominator(10 ** 6)
+    num, den = ratio.numerator, ratio.denominator
+    return lambda line_num: ((line_num + 1) * num) // den \
+        > (line_num * num) // den
+
+
+def sample_balanced(lines, ratio):
+    """Yield lines evenly spread across the input, deterministically.
+
+    Keep exactly floor(total * ratio) lines, one every 1 / ratio lines on
+    average, without rounding the sampling step.
+    """
+    is_picked = _get_balanced_picker(ratio)
+    for line_num, line in enumerate(lines):
+        if is_picked(line_num):
+            yield line
+
+
+def sample_bernoulli(lines, ratio, seed=None):
+    """Yield each line independently with probability ratio."""
+    rng = random.Random(seed)
+    for line in lines:
+        if rng.random() < ratio:
+            yield line
+
+
+def sample_reservoir(lines, num_lines, seed=None):
+    """Return exactly num_lines lines sampled uniformly (or all lines).
+
+    Lines are sampled in a single pass with reservoir sampling and returned
+    in input order.
+    """
+    rng = random.Random(seed)
+    reservoir = []
+    for line_num, line in enumerate(lines):
+        if line_num < num_lines:
+            reservoir.append((line_num, line))
+        else:
+            pick = rng.randint(0, line_num)
+            if pick < num_lines:
+                reservoir[pick] = (line_num, line)
+    return [line for _, line in sorted(reservoir, key=lambda x: x[0])]
+
+
+def count_lines(filepath):
+    """Return the number of lines of a file, counting newlines in bulk.
+
+    Compressed files are decompressed on the fly.
+    """
+    count = 0
+    last_byte = b'\n'
+    with futils.open_stream(filepath, 'rb') as input_stream:
+        for data in iter(lambda: input_stream.read(READ_BUFFER_SIZE), b''):
+            count += data.count(b'\n')
+            last_byte = data[-1:]
+    return count if last_byte == b'\n' else count + 1
+
+
+def get_index_filepath(filepath):
+    """Return the filepath of the line-offset index of filepath."""
+    return '{}.idx'.format(filepath)
+
+
+def build_line_index(filepath):
+    """Build and save the line-offset index of filepath.
+
+    The index is an array of unsigned 64-bit integers: the size of the
+    indexed file followed by the byte offset of the start of each line.
+    """
+    logger.info('Building line-offset index of {}'.format(filepath))
+    file_size = os.path.getsize(filepath)
+    offsets = array.array('Q', [file_size])
+    if file_size:
+        offsets.append(0)
+    position = 0
+    with open(filepath, 'rb') as input_stream:
+        for data in iter(lambda: input_stream.read(READ_BUFFER_SIZE), b''):
+            lines = data.split(b'\n')
+            lines.pop()
+            offsets.extend(position + line_end for line_end
+                           in itertools.accumulate(len(line) + 1
+                                                   for line in lines))
+            position += len(data)
+    if file_size and offsets[-1] == file_size:
+        offsets.pop()
+    with open(get_index_filepath(filepath), 'wb') as index_stream:
+        offsets.tofile(index_stream)
+    return offsets
+
+
+def load_line_index(filepath):
+    """Return the line-offset index of filepath.
+
+    Return None if there is no index or if it is out of date.
+    """
+    index_filepath = get_index_filepath(filepath)
+    if not os.path.exists(index_filepath):
+        return None
+    offsets = array.array('Q')
+    with open(index_filepath, 'rb') as index_stream:
+        offsets.frombytes(index_stream.read())
+    if not offsets or offsets[0] != os.path.getsize(filepath):
+        logger.info('Line-offset index {} is out of date'
+                    .format(index_filepath))
+        return None
+    return offsets
+
+
+def get_indexed_line_nums(num_total_lines, mode, ratio=None,
+                          num_lines=None, seed=None):
+    """Return the sorted line numbers to sample among num_total_lines.
+
+    mode is one of 'top', 'balance' or 'random', and either ratio or
+    num_lines is set. Used to sample a file through its line-offset index,
+    without scanning it.
+    """
+    if mode == 'top':
+        if num_lines is None:
+            num_lines = math.floor(num_total_lines * ratio)
+        return range(min(num_lines, num_total_lines))
+    if mode == 'balance':
+        if ratio is None:
+            ratio = min(num_lines / num_total_lines, 1) \
+                if num_total_lines else 0
+        is_picked = _get_balanced_picker(ratio)
+        return [line_num for line_num in range(num_total_lines)
+                if is_picked(line_num)]
+    rng = random.Random(seed)
+    if num_lines is not None:
+        return sorted(rng.sample(range(num_total_lines),
+                                 min(num_lines, num_total_lines)))
+    # Skip directly to the next Bernoulli pick (geometric distribution)
+    line_nums = []
+    line_num = -1
+    log_skip_prob = math.log(1 - ratio)
+    while True:
+        line_num += 1 + math.floor(math.log(1 - rng.random())
+                                   / log_skip_prob)
+        if line_num >= num_total_lines:
+            return line_nums
+        line_nums.append(line_num)
+
+
+def read_lines_at(filepath, offsets, line_nums):
+    """Yield the lines of filepath at line_nums, seeking through offsets."""
+    with open(filepath, 'rb') as input_stream:
+        next_line_num = None
+        for line_num in line_nums:
+            if line_num != next_line_num:
+                input_stream.seek(offsets[line_num + 1])
+            yield input_stream.readline()
+            next_line_num = line_num + 1
+
+
+def _get_sample_output_filepath(args, compression):
+    if args.input_filepath == '-':
+        return '-'
+    input_basename = args.input_filepath
+    input_compression = zutils.get_compression(input_basename)
+    if input_compression:
+        input_basename = input_basename[
+            :-len(zutils.EXTENSIONS[input_compression])]
+    if input_basename.endswith('.txt'):
+        input_basename = input_basename.split('.txt')[0]
+    if args.percent is not None:
+        sample_size = args.percent
+    else:
+        sample_size = '{}lines'.format(args.num_lines)
+    if args.balance:
+        output_filepath = '{}.sample{}.balanced.txt'.format(input_basename,
+                                                            sample_size)
+    elif args.random:
+        output_filepath = '{}.sample{}.random.txt'.format(input_basename,
+                                                          sample_size)
+    else:
+        output_filepath = '{}.sample{}.txt'.format(input_basename,
+                                                   sample_size)
+    return zutils.add_extension(output_filepath, compression)
+
+
+def _iter_indexed_sample(args, mode, ratio):
+    offsets = load_line_index(args.input_filepath)
+    if offsets is None:
+        offsets = build_line_index(args.input_filepath)
+    line_nums = get_indexed_line_nums(
+        len(offsets) - 1, mode, ratio, args.num_lines, args.seed)
+    return read_lines_at(args.input_filepath, offsets, line_nums)
+
+
+def _iter_streamed_sample(args, mode, ratio, input_stream):
+    if mode == 'random':
+        if ratio is not None:
+            return sample_bernoulli(input_stream, ratio, args.seed)
+        return sample_reservoir(input_stream, args.num_lines, args.seed)
+    if (mode == 'top' and ratio is not None) \
+            or (mode == 'balance' and ratio is None):
+        if args.input_filepath == '-':
+            raise InvalidParameterError(
+                'Cannot sample a percentage of the top lines or a number of '
+                'balanced lines from stdin: use --random or a file input')
+        logger.info('Counting number of lines in file...')
+        count = count_lines(args.input_filepath)
+        logger.info('Total lines = {}'.format(count))
+        if mode == 'top':
+            return sample_top(input_stream, int(count * ratio))
+        ratio = min(args.num_lines / count, 1) if count else 0
+    if mode == 'top':
+        return sample_top(input_stream, args.num_lines)
+    return sample_balanced(input_stream, ratio)
+
+
+def _get_sample_mode(args):
+    if args.balance:
+        return 'balance'
+    if args.random:
+        return 'random'
+    return 'top'
+
+
+def sample(args):
+    """Sample the lines of a file, as per the sample command.
+
+    args holds the arguments of the sample command.
+    """
+    if args.percent is not None and not 0 < args.percent < 100:
+        raise InvalidParameterError(
+            'Specified percent param should be in ]0, 100[')
+    if args.num_lines is not None and args.num_lines < 0:
+        raise InvalidParameterError(
+            'Specified lines param should be positive')
+    if args.index and args.input_filepath == '-':
+        raise InvalidParameterError('Cannot index stdin')
+    if args.index and zutils.get_compression(args.input_filepath):
+        raise InvalidParameterError('Cannot index a compressed file')
+    ratio = args.percent / 100 if args.percent is not None else None
+    mode = _get_sample_mode(args)
+    if args.output_filepath:
+        compression = zutils.get_compression(args.output_filepath,
+                                             args.compress)
+        output_filepath = zutils.add_extension(args.output_filepath,
+                                               compression)
+    else:
+        # Keep the compression of the input file by default
+        compression = args.compress or zutils.get_compression(
+            args.input_filepath)
+        output_filepath = _get_sample_output_filepath(args, compression)
+    logger.info('Sampling input file {} with mode = {}'
+                .format(args.input_filepath, mode))
+    with futils.open_stream(args.input_filepath, 'rb') as input_stream, \
+            futils.open_stream(output_filepath, 'wb',
+                               compression) as output_stream:
+        if args.index:
+            lines = _iter_indexed_sample(args, mode, ratio)
+        else:
+            lines = _iter_streamed_sample(args, mode, ratio, input_stream)
+        for line in lines:
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            output_stream.write(line)
+    logger.info('Done sampling file to {}'.format(output_filepath))
@@ -0,0 +1,91 @@
+"""Scheduler utils.
+
+Methods used to balance archives across workers by byte size rather than
+by count: oversized archives are split into sub-tasks, tasks are handed
+to workers largest first (Longest Processing Time first), and the
+expected makespan of the resulting schedule is estimated.
+
+Pool workers pull the next task as soon as they are done with the
+previous one: feeding tasks largest first with a chunksize of 1 thus
+yields an LPT schedule, whose makespan is at most the ideal makespan
+(total size / number of workers) plus the size of the largest task.
+"""
+
+import os
+import heapq
+import logging
+
+from witokit.utils.streams import ArxivChunk
+
+__all__ = ('get_task_size', 'get_max_task_size', 'schedule',
+           'get_makespan', 'partition')
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of tasks per worker the largest archives are split into,
+# bounding the makespan to 1 + 1 / TASKS_PER_WORKER times the ideal one
+TASKS_PER_WORKER = 4
+
+# Size above which multistream archives are split into chunks in batch and
+# incremental runs, so that the chunks of an archive only depend on its size
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def get_task_size(source):
+    """Return the size in bytes of an XML filepath or ArxivChunk source."""
+    if not isinstance(source, ArxivChunk):
+        return os.path.getsize(source)
+    end = source.end if source.end is not None \
+        else os.path.getsize(source.arxiv)
+    return end - source.start
+
+
+def get_max_task_size(total_size, num_workers):
+    """Return the size above which a task should be split.
+
+    No task is split for a single worker.
+    """
+    if num_workers <= 1:
+        return total_size
+    return total_size / (num_workers * TASKS_PER_WORKER)
+
+
+def schedule(tasks, key=get_task_size):
+    """Return tasks sorted largest first by key."""
+    return sorted(tasks, key=key, reverse=True)
+
+
+def get_makespan(task_sizes, num_workers):
+    """Return the makespan of handing task_sizes in order to num_workers.
+
+    Each task goes to the least loaded worker, as with a pool of workers
+    pulling tasks from a queue.
+    """
+    loads = [0] * max(min(num_workers, len(task_sizes)), 1)
+    for task_size in task_sizes:
+        heapq.heappush(loads, heapq.heappop(loads) + task_size)
+    return max(loads)
+
+
+def partition(tasks, num_parts, key=get_task_size):
+    """Split tasks into at most num_parts contiguous groups of similar size.
+
+    Group boundaries are set where the cumulative size of the tasks
+    crosses a multiple of total size / num_parts.
+    """
+    num_parts = min(num_parts, len(tasks))
+    sizes = [key(task) for task in tasks]
+    total_size = sum(sizes)
+    parts = []
+    part = []
+    cumulative_size = 0
+    for task, size in zip(tasks, sizes):
+        if part and cumulative_size >= total_size * (len(parts) + 1) \
+                / num_parts and len(parts) < num_parts - 1:
+            parts.append(part)
+            part = []
+        part.append(task)
+        cumulative_size += size
+    if part:
+        parts.append(part)
+    return parts
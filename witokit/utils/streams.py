@@ -0,0 +1,385 @@
+"""Stream utils.
+
+Methods used to decompress .bz2 archives on the fly, without writing the
+decompressed content to disk, and to split multistream archives into
+byte-range chunks which can be decompressed independently.
+
+The bz2 streams of a multistream archive can also be decompressed by
+several threads at once (bz2 decompression releases the GIL), in blocks
+of streams read into reusable buffers, and yielded in order.
+"""
+
+import os
+import re
+import bz2
+import mmap
+import bisect
+import shutil
+import logging
+import tempfile
+import functools
+import threading
+import contextlib
+import collections
+import concurrent.futures
+
+import witokit.utils.files as futils
+import witokit.utils.metrics as mtutils
+
+__all__ = ('ArxivChunk', 'iter_decompressed', 'decompressed_fifo',
+           'stream_fifo', 'xml_source', 'get_index_filepath',
+           'get_stream_offsets', 'split_arxiv', 'get_xml_filepath')
+
+logger = logging.getLogger(__name__)
+
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Compressed size of the blocks of streams decompressed by each thread
+PARALLEL_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Number of blocks decompressed ahead of the writer, per thread
+PARALLEL_BLOCKS_AHEAD = 2
+
+# Magic bytes starting every bz2 stream: 'BZh' + block size + block magic
+STREAM_HEADER_PATTERN = re.compile(b'BZh[1-9]1AY&SY')
+
+ArxivChunk = collections.namedtuple(
+    'ArxivChunk', ['arxiv', 'header_end', 'start', 'end', 'num', 'offsets'])
+ArxivChunk.__new__.__defaults__ = (None,)
+ArxivChunk.__doc__ = """A byte range [start, end) of a .bz2 archive.
+
+The range covers complete bz2 streams. header_end is the end offset of the
+first stream of the archive holding the <siteinfo> header, to be prepended
+to the content of all chunks but the first. num is the chunk number, None
+if the chunk covers the whole archive. offsets is the tuple of the offsets
+of the streams in the (start, end) range, None if not known yet.
+"""
+
+
+def _iter_decompressed_range(arxiv_byte_stream, start, end):
+    arxiv_byte_stream.seek(start)
+    remaining = end - start if end is not None else None
+    decompressor = bz2.BZ2Decompressor()
+    in_stream = False
+    while remaining is None or remaining > 0:
+        read_size = READ_BUFFER_SIZE if remaining is None \
+            else min(READ_BUFFER_SIZE, remaining)
+        data = arxiv_byte_stream.read(read_size)
+        if not data:
+            break
+        if remaining is not None:
+            remaining -= len(data)
+        while data:
+            in_stream = True
+            decompressed_data = decompressor.decompress(data)
+            mtutils.increment('decompressed_bytes', len(decompressed_data))
+            yield decompressed_data
+            if not decompressor.eof:
+                break
+            in_stream = False
+            data = decompressor.unused_data
+            decompressor = bz2.BZ2Decompressor()
+    if in_stream:
+        raise EOFError('Archive {} ended before the end-of-stream marker was '
+                       'reached'.format(arxiv_byte_stream.name))
+
+
+def _get_blocks(arxiv, start, end, offsets=None):
+    """Return the blocks of streams of the [start, end) range of arxiv.
+
+    Each block is the list of the offsets of its streams followed by its
+    end offset, and spans about PARALLEL_BLOCK_SIZE compressed bytes.
+    offsets are the stream offsets in the (start, end) range, read from
+    the archive if None.
+    """
+    if offsets is None:
+        offsets = [offset for offset in get_stream_offsets(arxiv)
+                   if start < offset < end]
+    blocks = []
+    block = [start]
+    for offset in offsets:
+        if offset - block[0] >= PARALLEL_BLOCK_SIZE:
+            blocks.append(block + [offset])
+            block = []
+        block.append(offset)
+    blocks.append(block + [end])
+    return blocks
+
+
+_buffers = threading.local()
+
+
+def _get_buffer(size):
+    """Return a memoryview of size bytes of the buffer of this thread."""
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+        buffer = _buffers.buffer = bytearray(size)
+    return memoryview(buffer)[:size]
+
+
+def _decompress_block(arxiv, block):
+    """Return the list of the decompressed streams of a block of arxiv."""
+    view = _get_buffer(block[-1] - block[0])
+    with open(arxiv, 'rb', buffering=0) as arxiv_byte_stream:
+        arxiv_byte_stream.seek(block[0])
+        num_read = 0
+        while num_read < len(view):
+            size = arxiv_byte_stream.readinto(view[num_read:])
+            if not size:
+                break
+            num_read += size
+    decompressed_streams = []
+    for start, end in zip(block[:-1], block[1:]):
+        data = view[start - block[0]:min(end - block[0], num_read)]
+        while data:
+            decompressor = bz2.BZ2Decompressor()
+            decompressed_streams.append(decompressor.decompress(data))
+            if not decompressor.eof:
+                raise EOFError('Archive {} ended before the end-of-stream '
+                               'marker was reached'.format(arxiv))
+            # Streams missing from the offsets start in the unused data
+            data = decompressor.unused_data
+    return decompressed_streams
+
+
+def _iter_decompressed_parallel(arxiv_byte_stream, start, end, num_threads,
+                                offsets):
+    if end is None:
+        end = os.fstat(arxiv_byte_stream.fileno()).st_size
+    blocks = _get_blocks(arxiv_byte_stream.name, start, end, offsets)
+    if len(blocks) < 2:
+        yield from _iter_decompressed_range(arxiv_byte_stream, start, end)
+        return
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        pending = collections.deque()
+        for block in blocks:
+            pending.append(executor.submit(
+                _decompress_block, arxiv_byte_stream.name, block))
+            if len(pending) < num_threads * PARALLEL_BLOCKS_AHEAD:
+                continue
+            for decompressed_data in pending.popleft().result():
+                mtutils.increment('decompressed_bytes', len(decompressed_data))
+                yield decompressed_data
+        while pending:
+            for decompressed_data in pending.popleft().result():
+                mtutils.increment('decompressed_bytes', len(decompressed_data))
+                yield decompressed_data
+
+
+def iter_decompressed(arxiv, start=0, end=None, header_end=0, num_threads=1,
+                      offsets=None):
+    """Yield decompressed chunks of bytes from a .bz2 archive.
+
+    Multistream archives (several concatenated bz2 streams) are handled by
+    starting a new decompressor at the end of each stream. If start and end
+    are set, only decompress the streams in the [start, end) byte range,
+    prefixed with the content of the [0, header_end) byte range. If
+    num_threads is greater than 1, the streams of multistream archives are
+    decompressed by num_threads threads, and still yielded in order, from
+    the stream offsets of the range, if known.
+    """
+    with open(arxiv, 'rb') as arxiv_byte_stream:
+        if start and header_end:
+            yield from _iter_decompressed_range(arxiv_byte_stream, 0,
+                                                header_end)
+        if num_threads > 1:
+            yield from _iter_decompressed_parallel(arxiv_byte_stream, start,
+                                                   end, num_threads, offsets)
+        else:
+            yield from _iter_decompressed_range(arxiv_byte_stream, start,
+                                                end)
+
+
+def get_index_filepath(arxiv):
+    """Return the filepath to the multistream index of a .bz2 archive.
+
+    Return None if arxiv is not a multistream archive or if its index was
+    not downloaded alongside it.
+    """
+    index_filename, found = re.subn(r'multistream([0-9]*)\.xml',
+                                    r'multistream-index\1.txt',
+                                    os.path.basename(arxiv))
+    if not found:
+        return None
+    index_filepath = os.path.join(os.path.dirname(arxiv), index_filename)
+    if not os.path.exists(index_filepath):
+        return None
+    return index_filepath
+
+
+def _get_indexed_offsets(index_filepath):
+    offsets = {0}
+    with bz2.open(index_filepath, 'rt', encoding='utf-8') as index_stream:
+        for line in index_stream:
+            offsets.add(int(line.split(':', 1)[0]))
+    return sorted(offsets)
+
+
+def _get_scanned_offsets(arxiv):
+    if not os.path.getsize(arxiv):
+        return [0]
+    with open(arxiv, 'rb') as arxiv_byte_stream:
+        with mmap.mmap(arxiv_byte_stream.fileno(), 0,
+                       access=mmap.ACCESS_READ) as arxiv_mmap:
+            return [match.start() for match
+                    in STREAM_HEADER_PATTERN.finditer(arxiv_mmap)]
+
+
+def get_stream_offsets(arxiv):
+    """Return the sorted list of byte offsets of the bz2 streams of arxiv.
+
+    Offsets are read from the multistream index when available. Otherwise,
+    the archive is scanned for byte-aligned bz2 stream headers. A regular
+    (single stream) archive returns [0].
+    """
+    index_filepath = get_index_filepath(arxiv)
+    if index_filepath:
+        logger.debug('Reading stream offsets from {}'.format(index_filepath))
+        return _get_indexed_offsets(index_filepath)
+    logger.debug('Scanning {} for bz2 stream offsets'.format(arxiv))
+    return _get_scanned_offsets(arxiv)
+
+
+def _is_header_stream(arxiv, header_end):
+    return b'<page>' not in b''.join(iter_decompressed(arxiv, 0, header_end))
+
+
+def split_arxiv(arxiv, num_chunks):
+    """Split a .bz2 archive into at most num_chunks ArxivChunks.
+
+    Chunks are balanced by compressed byte size and always cover complete
+    bz2 streams, so that they can be decompressed concurrently. Archives
+    which are not multistream (or which do not start with a header stream)
+    cannot be split and are returned as a single chunk. Stream offsets are
+    only read once, and stored in the chunks.
+    """
+    whole_arxiv = [ArxivChunk(arxiv, 0, 0, None, None)]
+    if num_chunks <= 1:
+        return whole_arxiv
+    offsets = get_stream_offsets(arxiv)
+    if len(offsets) < 3 or not _is_header_stream(arxiv, offsets[1]):
+        logger.debug('Cannot split archive {}'.format(arxiv))
+        return whole_arxiv
+    header_end = offsets[1]
+    arxiv_size = os.path.getsize(arxiv)
+    chunk_size = (arxiv_size - header_end) / num_chunks
+    boundaries = [0]
+    for offset in offsets[2:]:
+        if offset - header_end >= chunk_size * len(boundaries):
+            boundaries.append(offset)
+    boundaries.append(arxiv_size)
+    logger.debug('Splitting archive {} into {} chunks'
+                 .format(arxiv, len(boundaries) - 1))
+    return [ArxivChunk(arxiv, header_end, start, end, num, tuple(
+        offsets[bisect.bisect_right(offsets, start):
+                bisect.bisect_left(offsets, end)]))
+            for num, (start, end)
+            in enumerate(zip(boundaries[:-1], boundaries[1:]), start=1)]
+
+
+def get_xml_filepath(source):
+    """Return the filepath of the decompressed content of an ArxivChunk.
+
+    If source is already an XML filepath, return it as is.
+    """
+    if not isinstance(source, ArxivChunk):
+        return source
+    xml_filepath = source.arxiv.rsplit('.bz2')[0]
+    if source.num is None:
+        return xml_filepath
+    return '{}-chunk{}'.format(xml_filepath, source.num)
+
+
+def _write_to_fifo(write, fifo_filepath, errors):
+    try:
+        with open(fifo_filepath, 'wb') as fifo_stream:
+            write(fifo_stream)
+    except BrokenPipeError:
+        logger.debug('Reader closed named pipe {} before the end of its '
+                     'input'.format(fifo_filepath))
+    except (OSError, EOFError) as err:
+        errors.append(err)
+
+
+@contextlib.contextmanager
+def _fifo(filename, write, error_message):
+    """Yield the path to a FIFO fed by write(fifo_stream) in a thread.
+
+    error_message is logged if write fails.
+    """
+    tmp_dirpath = tempfile.mkdtemp(prefix='witokit-')
+    fifo_filepath = os.path.join(tmp_dirpath, filename)
+    os.mkfifo(fifo_filepath)
+    errors = []
+    writer = threading.Thread(target=_write_to_fifo,
+                              args=(write, fifo_filepath, errors),
+                              daemon=True)
+    writer.start()
+    try:
+        yield fifo_filepath
+    finally:
+        while writer.is_alive():
+            # Unblock a writer still waiting for (or writing to) a reader
+            fifo_fd = os.open(fifo_filepath, os.O_RDONLY | os.O_NONBLOCK)
+            os.close(fifo_fd)
+            writer.join(timeout=0.1)
+        shutil.rmtree(tmp_dirpath)
+    if errors:
+        logger.error(error_message)
+        raise errors[0]
+
+
+def _write_chunk(chunk, fifo_stream):
+    for data in iter_decompressed(chunk.arxiv, chunk.start, chunk.end,
+                                  chunk.header_end, offsets=chunk.offsets):
+        fifo_stream.write(data)
+
+
+@contextlib.contextmanager
+def decompressed_fifo(chunk):
+    """Expose the decompressed content of an ArxivChunk as a named pipe.
+
+    Yield the path to a FIFO named after the decompressed archive. A
+    background thread feeds it with the output of bz2 decompression so
+    that readers expecting a filepath (e.g. wikiextractor) can consume the
+    XML content without it ever being written to disk.
+    """
+    with _fifo(os.path.basename(get_xml_filepath(chunk)),
+               functools.partial(_write_chunk, chunk),
+               'Could not decompress archive {}'.format(chunk.arxiv)) \
+            as fifo_filepath:
+        yield fifo_filepath
+
+
+def _write_stream(filepath, fifo_stream):
+    with futils.open_stream(filepath, 'rb') as input_stream:
+        shutil.copyfileobj(input_stream, fifo_stream, READ_BUFFER_SIZE)
+
+
+@contextlib.contextmanager
+def stream_fifo(filepath='-', filename='stdin.xml'):
+    """Expose the XML content of filepath ('-' for stdin) as a named pipe.
+
+    Compressed content (bz2, gzip or zstd) is decompressed on the fly by a
+    background thread, as with decompressed_fifo. Yield the path to a FIFO
+    named filename.
+    """
+    with _fifo(filename, functools.partial(_write_stream, filepath),
+               'Could not read {}'.format(
+                   'stdin' if filepath == '-' else filepath)) \
+            as fifo_filepath:
+        yield fifo_filepath
+
+
+@contextlib.contextmanager
+def xml_source(source):
+    """Yield a filepath to the XML content of source.
+
+    If source is an ArxivChunk, its decompressed content is exposed through
+    a named pipe. Otherwise, source is an XML filepath yielded as is.
+    """
+    if isinstance(source, ArxivChunk):
+        with decompressed_fifo(source) as fifo_filepath:
+            yield fifo_filepath
+    else:
+        yield source
@@ -0,0 +1,304 @@
+"""Token id utils.
+
+Methods used to write tokenized sentences as a binary corpus of token ids,
+along with a frequency-counted vocabulary, and to read it back through
+memory maps.
+
+A corpus saved under a filepath prefix is made of three files:
+- prefix.ids: the token ids of all sentences, as little-endian uint32;
+- prefix.offsets: the offset (in tokens) of each sentence in prefix.ids,
+  followed by the total number of tokens, as little-endian uint64;
+- prefix.vocab: one token<TAB>count line per token id, most frequent
+  tokens first.
+Both binary files can be read with numpy.memmap or numpy.fromfile.
+
+Each worker encodes its sentences with its own local vocabulary. Local
+vocabularies are then merged into the global one, and the local token ids
+of each worker are remapped to global ids at their final position in the
+corpus.
+"""
+
+import os
+import sys
+import mmap
+import array
+import logging
+import collections
+
+from witokit.exceptions.parameter import InvalidParameterError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ('IDS_EXTENSION', 'OFFSETS_EXTENSION', 'VOCAB_EXTENSION',
+           'TokenIdWriter', 'TokenIdCorpus', 'load_vocab', 'merge_vocabs',
+           'save_vocab', 'allocate', 'remap')
+
+logger = logging.getLogger(__name__)
+
+IDS_EXTENSION = '.ids'
+OFFSETS_EXTENSION = '.offsets'
+VOCAB_EXTENSION = '.vocab'
+
+ID_TYPECODE = 'I'
+OFFSET_TYPECODE = 'Q'
+ID_DTYPE = '<u4'
+OFFSET_DTYPE = '<u8'
+
+# Number of token ids buffered before being written to disk
+BUFFER_SIZE = 1024 * 1024
+
+
+def _write_array(values, stream):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    values.tofile(stream)
+
+
+def _read_array(typecode, stream, size=-1):
+    """Read at most size values of typecode from stream, -1 for all."""
+    values = array.array(typecode)
+    data = stream.read(size * values.itemsize if size >= 0 else -1)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class TokenIdWriter():
+    """Text stream writing tokenized sentences as token ids.
+
+    Text written to the stream holds one sentence per line with tokens
+    separated by spaces. Token ids are local to the writer, which saves its
+    vocabulary with the count of each token when closed.
+    """
+
+    def __init__(self, filepath_prefix):
+        """Open the .ids and .offsets files of filepath_prefix."""
+        self._filepath_prefix = filepath_prefix
+        self._ids_stream = open(filepath_prefix + IDS_EXTENSION, 'wb')
+        self._offsets_stream = open(filepath_prefix + OFFSETS_EXTENSION,
+                                    'wb')
+        self._token_ids = {}
+        self._counts = []
+        self._ids = array.array(ID_TYPECODE)
+        self._offsets = array.array(OFFSET_TYPECODE, [0])
+        self._num_tokens = 0
+        self._pending = ''
+
+    def __enter__(self):
+        """Return the writer."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the writer."""
+        self.close()
+
+    def _add_sentence(self, tokens):
+        for token in tokens:
+            token_id = self._token_ids.get(token)
+            if token_id is None:
+                token_id = self._token_ids[token] = len(self._counts)
+                self._counts.append(0)
+            self._counts[token_id] += 1
+            self._ids.append(token_id)
+        self._num_tokens += len(tokens)
+        self._offsets.append(self._num_tokens)
+        if len(self._ids) >= BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        _write_array(self._ids, self._ids_stream)
+        _write_array(self._offsets, self._offsets_stream)
+        self._ids = array.array(ID_TYPECODE)
+        self._offsets = array.array(OFFSET_TYPECODE)
+
+    def write(self, text):
+        """Encode the complete lines of text, skipping empty ones."""
+        lines = (self._pending + text).split('\n')
+        self._pending = lines.pop()
+        for line in lines:
+            if line:
+                self._add_sentence(line.split(' '))
+
+    def close(self):
+        """Flush token ids and offsets and save the local vocabulary."""
+        if self._ids_stream.closed:
+            return
+        if self._pending:
+            self._add_sentence(self._pending.split(' '))
+            self._pending = ''
+        self._flush()
+        self._ids_stream.close()
+        self._offsets_stream.close()
+        save_vocab(self._filepath_prefix, zip(self._token_ids, self._counts))
+
+
+def save_vocab(filepath_prefix, vocab):
+    """Save an iterable of (token, count) to filepath_prefix.vocab."""
+    with open(filepath_prefix + VOCAB_EXTENSION, 'w',
+              encoding='utf-8') as vocab_stream:
+        for token, count in vocab:
+            vocab_stream.write('{}\t{}\n'.format(token, count))
+
+
+def load_vocab(filepath_prefix):
+    """Return the list of (token, count) of filepath_prefix.vocab."""
+    vocab = []
+    with open(filepath_prefix + VOCAB_EXTENSION, 'r',
+              encoding='utf-8') as vocab_stream:
+        for line in vocab_stream:
+            token, count = line.rstrip('\n').rsplit('\t', 1)
+            vocab.append((token, int(count)))
+    return vocab
+
+
+def merge_vocabs(filepath_prefixes):
+    """Merge the local vocabularies of filepath_prefixes.
+
+    Return the global vocabulary, as a list of (token, count) sorted by
+    decreasing count, and for each local vocabulary the array mapping its
+    local token ids to global ones.
+    """
+    local_tokens = []
+    counts = collections.Counter()
+    for filepath_prefix in filepath_prefixes:
+        vocab = load_vocab(filepath_prefix)
+        counts.update(dict(vocab))
+        local_tokens.append([token for token, _ in vocab])
+    vocab = sorted(counts.items(), key=lambda x: (-x[1], x[0]))
+    if len(vocab) >= 2 ** 32:
+        raise InvalidParameterError('Vocabulary of {} tokens does not fit '
+                                    'uint32 token ids'.format(len(vocab)))
+    token_ids = {token: token_id for token_id, (token, _)
+                 in enumerate(vocab)}
+    return vocab, [array.array(ID_TYPECODE, [token_ids[token] for token
+                                             in tokens])
+                   for tokens in local_tokens]
+
+
+def allocate(filepath_prefix, filepath_prefixes):
+    """Create the .ids and .offsets files of the concatenated corpora.
+
+    Return for each corpus of filepath_prefixes its (token_offset,
+    sentence_offset) in the concatenated corpus, to be passed to remap.
+    """
+    item_sizes = (array.array(ID_TYPECODE).itemsize,
+                  array.array(OFFSET_TYPECODE).itemsize)
+    positions = []
+    num_tokens = 0
+    num_sentences = 0
+    for prefix in filepath_prefixes:
+        positions.append((num_tokens, num_sentences))
+        num_tokens += os.path.getsize(prefix + IDS_EXTENSION) \
+            // item_sizes[0]
+        num_sentences += os.path.getsize(prefix + OFFSETS_EXTENSION) \
+            // item_sizes[1] - 1
+    with open(filepath_prefix + IDS_EXTENSION, 'wb') as ids_stream:
+        ids_stream.truncate(num_tokens * item_sizes[0])
+    with open(filepath_prefix + OFFSETS_EXTENSION, 'wb') as offsets_stream:
+        # The offsets of each corpus are written by remap, but the last one
+        offsets_stream.seek(num_sentences * item_sizes[1])
+        _write_array(array.array(OFFSET_TYPECODE, [num_tokens]),
+                     offsets_stream)
+    logger.info('Allocated corpus of {} tokens and {} sentences'
+                .format(num_tokens, num_sentences))
+    return positions
+
+
+def remap(filepath_prefix, local_prefix, mapping, token_offset,
+          sentence_offset):
+    """Write the corpus of local_prefix into the corpus of filepath_prefix.
+
+    Local token ids are mapped to global ones with mapping and written at
+    token_offset, and sentence offsets are shifted by token_offset and
+    written at sentence_offset, as returned by allocate. Both files are
+    written in place, so that several corpora can be remapped at once.
+    """
+    if numpy is not None:
+        mapping = numpy.frombuffer(mapping, dtype=numpy.uint32)
+    with open(local_prefix + IDS_EXTENSION, 'rb') as local_stream, \
+            open(filepath_prefix + IDS_EXTENSION, 'r+b') as ids_stream:
+        ids_stream.seek(token_offset * array.array(ID_TYPECODE).itemsize)
+        while True:
+            local_ids = _read_array(ID_TYPECODE, local_stream, BUFFER_SIZE)
+            if not local_ids:
+                break
+            if numpy is not None:
+                ids_stream.write(mapping[numpy.frombuffer(
+                    local_ids, dtype=numpy.uint32)].astype(ID_DTYPE)
+                                 .tobytes())
+            else:
+                _write_array(array.array(ID_TYPECODE, [
+                    mapping[local_id] for local_id in local_ids]),
+                             ids_stream)
+    with open(local_prefix + OFFSETS_EXTENSION, 'rb') as local_stream, \
+            open(filepath_prefix + OFFSETS_EXTENSION, 'r+b') as offsets_stream:
+        offsets_stream.seek(
+            sentence_offset * array.array(OFFSET_TYPECODE).itemsize)
+        local_offsets = _read_array(OFFSET_TYPECODE, local_stream)
+        # The last local offset is the first one of the next corpus
+        _write_array(array.array(OFFSET_TYPECODE, [
+            offset + token_offset for offset in local_offsets[:-1]]),
+                     offsets_stream)
+
+
+def _map_array(filepath, typecode, dtype):
+    """Return a read-only, zero-copy array view of a binary file.
+
+    Return a numpy memmap if numpy is installed, a memoryview otherwise.
+    """
+    if numpy is not None:
+        if not os.path.getsize(filepath):
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(filepath, dtype=dtype, mode='r')
+    if sys.byteorder == 'big':
+        raise InvalidParameterError('Reading token ids on a big-endian '
+                                    'platform requires numpy')
+    if not os.path.getsize(filepath):
+        return memoryview(array.array(typecode))
+    with open(filepath, 'rb') as stream:
+        return memoryview(mmap.mmap(stream.fileno(), 0,
+                                    access=mmap.ACCESS_READ)).cast(typecode)
+
+
+class TokenIdCorpus():
+    """Memory-mapped binary corpus of token ids.
+
+    corpus[i] returns the token ids of the i-th sentence as a zero-copy
+    view of the .ids file: a numpy array if numpy is installed, a
+    memoryview otherwise. ids and offsets give access to the whole
+    arrays, and vocab to the list of (token, count) indexed by token id.
+    """
+
+    def __init__(self, filepath_prefix):
+        """Map the .ids and .offsets files and load the vocabulary."""
+        self.vocab = load_vocab(filepath_prefix)
+        self.ids = _map_array(filepath_prefix + IDS_EXTENSION, ID_TYPECODE,
+                              ID_DTYPE)
+        self.offsets = _map_array(filepath_prefix + OFFSETS_EXTENSION,
+                                  OFFSET_TYPECODE, OFFSET_DTYPE)
+
+    def __len__(self):
+        """Return the number of sentences."""
+        return max(len(self.offsets) - 1, 0)
+
+    def __getitem__(self, index):
+        """Return the token ids of sentence index."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Sentence index out of range')
+        return self.ids[int(self.offsets[index]):
+                        int(self.offsets[index + 1])]
+
+    def __iter__(self):
+        """Yield the token ids of each sentence."""
+        for index in range(len(self)):
+            yield self[index]
+
+    def get_tokens(self, index):
+        """Return the tokens of sentence index."""
+        return [self.vocab[token_id][0] for token_id in self[index]]
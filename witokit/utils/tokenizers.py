@@ -0,0 +1,190 @@
+"""Tokenizer backends.
+
+Each backend splits a raw text into sentences and each sentence into
+tokens:
+    - polyglot: polyglot tokenizers, with pycld2 language detection when
+                no language is specified (reference implementation);
+    - icu: PyICU break iterators used directly, without polyglot;
+    - regex: precompiled regular expressions, without any dependency. Much
+             faster but less exact: no dictionary-based word segmentation
+             (e.g. for Chinese, Japanese or Thai) and simplistic sentence
+             boundaries.
+Backend dependencies are optional: only the selected backend requires
+its dependencies to be installed.
+"""
+
+import re
+import logging
+import functools
+
+import witokit.utils.metrics as mtutils
+
+from witokit.exceptions.parameter import InvalidParameterError
+
+try:
+    import icu
+except ImportError:
+    icu = None
+
+try:
+    import pycld2
+    from polyglot.base import Sequence
+    from polyglot.detect import Detector
+    from polyglot.tokenize import SentenceTokenizer, WordTokenizer
+except ImportError:
+    pycld2 = None
+
+__all__ = ('TOKENIZERS', 'get_sentence_tokenizer', 'iter_sentences',
+           'tokenize_batch', 'tokenize')
+
+logger = logging.getLogger(__name__)
+
+TOKENIZERS = ('polyglot', 'icu', 'regex')
+
+NON_BMP_PATTERN = re.compile('[\U00010000-\U0010FFFF]')
+
+# Sentences end at line breaks or after terminal punctuation and spaces
+SENTENCE_BOUNDARY_PATTERN = re.compile(
+    r'\s*\n\s*|(?<=[.!?…।؟。！？])\s+')
+# Numbers (with decimal/thousand separators), words (with inner
+# apostrophes) or any other single non-space character
+TOKEN_PATTERN = re.compile(
+    r'\d+(?:[.,]\d+)*|[^\W\d_]\w*(?:[\'’]\w+)*|\w+|[^\w\s]')
+
+
+@functools.lru_cache(maxsize=None)
+def _get_polyglot_tokenizers(lang):
+    """Return polyglot sentence and word tokenizers for lang.
+
+    Tokenizers wrap ICU break iterators which are costly to create: they
+    are cached for the lifetime of the (worker) process.
+    """
+    return SentenceTokenizer(locale=lang), WordTokenizer(locale=lang)
+
+
+def _tokenize_polyglot(lang, raw_text):
+    """Yield the list of tokens of each sentence of raw_text with polyglot.
+
+    Mirror polyglot.text.Text.sentences and Sentence.words, reusing the
+    same tokenizers across calls.
+    """
+    try:
+        text_lang = lang or Detector(raw_text, quiet=True).language.code
+        sent_tokenizer, word_tokenizer = _get_polyglot_tokenizers(text_lang)
+        seq = sent_tokenizer.transform(Sequence(raw_text))
+    except ValueError:
+        logger.debug('Skipping empty text sequence')
+        return
+    except pycld2.error as err:
+        logger.debug('{}. Skipping sequence'.format(str(err)))
+        return
+    for start, end in zip(seq.idx[:-1], seq.idx[1:]):
+        sent = seq.text[start:end].strip()
+        if sent:
+            yield word_tokenizer.transform(Sequence(sent)).tokens()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_icu_breakers(lang):
+    """Return ICU sentence and word break iterators for lang.
+
+    Break iterators are cached for the lifetime of the (worker) process.
+    """
+    locale = icu.Locale(lang or 'root')
+    return (icu.BreakIterator.createSentenceInstance(locale),
+            icu.BreakIterator.createWordInstance(locale))
+
+
+def _iter_segments(breaker, text):
+    """Yield the segments of text between the boundaries of breaker."""
+    breaker.setText(text)
+    if not NON_BMP_PATTERN.search(text):
+        start = 0
+        for end in breaker:
+            yield text[start:end]
+            start = end
+    else:
+        # ICU boundaries are UTF-16 code unit offsets, which differ from
+        # str offsets for characters outside the Basic Multilingual Plane
+        utf16_text = text.encode('utf-16-le')
+        start = 0
+        for end in breaker:
+            yield utf16_text[2 * start:2 * end].decode('utf-16-le')
+            start = end
+
+
+def _tokenize_icu(lang, raw_text):
+    """Yield the list of tokens of each sentence of raw_text with PyICU."""
+    if not raw_text:
+        return
+    sent_breaker, word_breaker = _get_icu_breakers(lang)
+    for sent in _iter_segments(sent_breaker, raw_text):
+        sent = sent.strip()
+        if sent:
+            yield [token.strip() for token
+                   in _iter_segments(word_breaker, sent) if token.strip()]
+
+
+def _tokenize_regex(raw_text):
+    """Yield the list of tokens of each sentence of raw_text with regexes."""
+    for sent in SENTENCE_BOUNDARY_PATTERN.split(raw_text):
+        tokens = TOKEN_PATTERN.findall(sent)
+        if tokens:
+            yield tokens
+
+
+def get_sentence_tokenizer(name, lang=None):
+    """Return a tokenizer function for backend name and language lang.
+
+    The returned function takes a raw text as input and yields the list of
+    tokens of each of its sentences. If lang is None, the polyglot backend
+    detects the language of each text, and the icu backend uses the ICU
+    root locale.
+    """
+    if name == 'polyglot':
+        if pycld2 is None:
+            raise InvalidParameterError('The polyglot tokenizer requires '
+                                        'polyglot, pycld2 and pyicu')
+        return functools.partial(_tokenize_polyglot, lang)
+    if name == 'icu':
+        if icu is None:
+            raise InvalidParameterError('The icu tokenizer requires pyicu')
+        return functools.partial(_tokenize_icu, lang)
+    if name == 'regex':
+        return _tokenize_regex
+    raise InvalidParameterError('Unsupported tokenizer \'{}\'. Should be one '
+                                'of {}'.format(name, TOKENIZERS))
+
+
+def iter_sentences(tokenize_sentences, raw_text, lowercase):
+    """Yield each tokenized sentence of raw_text, tokens joined by spaces."""
+    for tokens in tokenize_sentences(raw_text):
+        if lowercase:
+            yield ' '.join(token.lower() for token in tokens)
+        else:
+            yield ' '.join(tokens)
+
+
+def tokenize_batch(raw_texts, lowercase, lang=None, tokenizer='polyglot'):
+    """Tokenize an iterable of raw_texts.
+
+    Yield one tokenized text per raw text, with one sentence per line (an
+    empty string for texts which could not be tokenized). If lang is set,
+    all texts are assumed to be in that language and language detection is
+    skipped. tokenizer is the name of the tokenizer backend, one of
+    TOKENIZERS.
+    """
+    tokenize_sentences = get_sentence_tokenizer(tokenizer, lang)
+    for raw_text in raw_texts:
+        with mtutils.timer('tokenize'):
+            tokenized_text = '\n'.join(
+                iter_sentences(tokenize_sentences, raw_text, lowercase))
+        yield tokenized_text
+
+
+def tokenize(raw_text, lowercase, lang=None, tokenizer='polyglot'):
+    """Tokenize raw_text with polyglot (or another tokenizer backend).
+
+    See tokenize_batch for details.
+    """
+    return next(tokenize_batch([raw_text], lowercase, lang, tokenizer))
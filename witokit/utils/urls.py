@@ -1,14 +1,23 @@
 """URL utils."""
 
+import re
+
 import witokit.utils.constants as const
 
 __all__ = ('get_wikipedia_dump_url', 'get_wikipedia_multi_pattern',
-           'get_wiki_arxiv_url', 'get_wikipedia_single_pattern')
+           'get_wiki_arxiv_url', 'get_wikipedia_single_pattern',
+           'get_multistream_multi_pattern',
+           'get_multistream_single_pattern',
+           'get_wiki_checksums_url', 'get_wikipedia_arxiv_matcher',
+           'get_wiki_dump_status_url')
+
 
+def get_wikipedia_dump_url(lang, date, dl_url=const.WIKI_DL_URL):
+    """Return the Wikipedia download URL corresponding to the lang and data.
 
-def get_wikipedia_dump_url(lang, date):
-    """Return the Wikipedia download URL corresponding to the lang and data."""
-    return '{}/{}wiki/{}'.format(const.WIKI_DL_URL, lang, date)
+    dl_url can be set to download from a mirror of the Wikimedia dump site.
+    """
+    return '{}/{}wiki/{}'.format(dl_url, lang, date)
 
 
 def get_wikipedia_multi_pattern(lang, date):
@@ -21,6 +30,51 @@ def get_wikipedia_single_pattern(lang, date):
     return r'({}wiki-{}-pages-articles+.xml.*bz2$)'.format(lang, date)
 
 
+def get_multistream_multi_pattern(lang, date):
+    """Return a regex pattern matching for wiki multistream .bz2 files.
+
+    Match both the numbered multistream archives and their indexes.
+    """
+    return (r'({}wiki-{}-pages-articles-multistream(-index)?[0-9]+'
+            r'.(xml|txt).*bz2$)'.format(lang, date))
+
+
+def get_multistream_single_pattern(lang, date):
+    """Return a regex pattern matching for wiki multistream .bz2 files.
+
+    Match both the single multistream archive and its index.
+    """
+    return (r'({}wiki-{}-pages-articles-multistream(-index)?'
+            r'.(xml|txt).*bz2$)'.format(lang, date))
+
+
+def get_wikipedia_arxiv_matcher(lang, date, multistream=False):
+    """Return a compiled regex matching wiki .bz2 filenames.
+
+    Numbered archives are matched by the 'multi' group and single archives
+    by the 'single' group, so that both are told apart in a single pass.
+    """
+    if multistream:
+        multi_pattern = get_multistream_multi_pattern(lang, date)
+        single_pattern = get_multistream_single_pattern(lang, date)
+    else:
+        multi_pattern = get_wikipedia_multi_pattern(lang, date)
+        single_pattern = get_wikipedia_single_pattern(lang, date)
+    return re.compile('(?P<multi>{})|(?P<single>{})'.format(
+        multi_pattern, single_pattern))
+
+
 def get_wiki_arxiv_url(wiki_dump_url, href):
     """Return a full URL from the href of a .bz2 archive."""
     return '{}/{}'.format(wiki_dump_url, href)
+
+
+def get_wiki_checksums_url(wiki_dump_url, lang, date, algorithm):
+    """Return the URL of the file listing the checksums of a dump."""
+    return '{}/{}wiki-{}-{}sums.txt'.format(wiki_dump_url, lang, date,
+                                            algorithm)
+
+
+def get_wiki_dump_status_url(wiki_dump_url):
+    """Return the URL of the machine-readable status file of a dump."""
+    return '{}/dumpstatus.json'.format(wiki_dump_url)